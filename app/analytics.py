@@ -1,19 +1,88 @@
 from __future__ import annotations
 
+import atexit
+import itertools
+import logging
+import queue
 import sqlite3
+import threading
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import List, Optional
 import time
 import os
 
 DB_PATH = Path(os.getenv("ANALYTICS_DB_PATH", "data/bot.db"))
 
+log = logging.getLogger(__name__)
+
+# Одно долгоживущее соединение на процесс (создаётся лениво) и блокировка для доступа из потоков
+_CONN: sqlite3.Connection | None = None
+_LOCK = threading.Lock()
+
+# Тексты запросов держим константами — так срабатывает кэш подготовленных выражений sqlite3
+_SQL_INSERT_EVENT = "INSERT INTO events(user_id, event, ts) VALUES (?, ?, ?);"
+_SQL_INSERT_ERROR = "INSERT INTO errors(user_id, code, ts) VALUES (?, ?, ?);"
+_SQL_INSERT_KIND = "INSERT INTO kinds(user_id, kind, ts) VALUES (?, ?, ?);"
+_SQL_INSERT_METRIC = "INSERT INTO metrics(user_id, metric, value, ts) VALUES (?, ?, ?, ?);"
+_SQL_UPSERT_COUNTER = """
+    INSERT INTO counters(user_id, processed_count) VALUES(?, 1)
+    ON CONFLICT(user_id) DO UPDATE SET processed_count = processed_count + 1;
+"""
+
+# Фоновая запись: record_* только кладут (операция, параметры) в очередь,
+# отдельный поток забирает пачками и пишет одной транзакцией.
+# Составная операция _MULTI — кортеж (операция, параметры), который целиком попадает в одну транзакцию
+# (например, все записи об одном видео)
+_MULTI = "multi"
+_WRITE_OPS = {
+    "event": _SQL_INSERT_EVENT,
+    "error": _SQL_INSERT_ERROR,
+    "metric": _SQL_INSERT_METRIC,
+    "kind": _SQL_INSERT_KIND,
+    "counter": _SQL_UPSERT_COUNTER,
+}
+_WRITE_Q: queue.Queue[tuple[str, tuple]] = queue.Queue()
+_WRITE_BATCH_MAX = 100
+_WRITE_INTERVAL_S = 0.05
+_WRITER: threading.Thread | None = None
+_WRITER_LOCK = threading.Lock()
+_STOP = "stop"
+
+# Периодическое обслуживание: PRAGMA optimize + усечение WAL (по умолчанию раз в 15 минут)
+_MAINTENANCE_INTERVAL_S = 900.0
+_MAINTENANCE_TIMER: threading.Timer | None = None
+
 
 def _get_conn() -> sqlite3.Connection:
-    """Возвращает соединение с БД SQLite, создаёт структуру при первом обращении."""
+    """Возвращает общее соединение с БД SQLite, создаёт структуру при первом обращении."""
+    global _CONN
+    if _CONN is not None:
+        return _CONN
+    with _LOCK:
+        if _CONN is None:
+            _CONN = _open_conn()
+            atexit.register(_close)
+            _schedule_maintenance()
+    return _CONN
+
+
+def _open_conn() -> sqlite3.Connection:
+    """Открывает соединение и однократно создаёт схему БД."""
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA journal_mode=WAL;")
+    # check_same_thread=False: запись идёт и из потоков asyncio.to_thread, доступ сериализуем через _LOCK
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # WAL + synchronous=NORMAL: fsync только на чекпойнтах, а не на каждый commit;
+    # временные данные в памяти, mmap 256 МБ и кэш страниц 64 МБ; ожидание блокировки до 3 сек
+    conn.executescript(
+        """
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA cache_size=-65536;
+        PRAGMA busy_timeout=3000;
+        """
+    )
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS events (
@@ -53,20 +122,153 @@ def _get_conn() -> sqlite3.Connection:
         );
         """
     )
+    # Типы входного медиа — отдельная таблица вместо событий 'kind:<тип>' (группировка по индексу без LIKE/substr)
+    has_kinds = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='kinds';"
+    ).fetchone()
+    if not has_kinds:
+        # Создание таблицы и однократный перенос ранее записанных событий 'kind:<тип>' — одной транзакцией:
+        # при сбое между ними не должна остаться пустая таблица, которая уже никогда не заполнится
+        # (sqlite3 сам не открывает транзакцию перед DDL, поэтому BEGIN явно)
+        with conn:
+            conn.execute("BEGIN;")
+            conn.execute(
+                """
+                CREATE TABLE kinds (
+                    user_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    ts INTEGER NOT NULL
+                );
+                """
+            )
+            conn.execute(
+                """
+                INSERT INTO kinds(user_id, kind, ts)
+                SELECT user_id, substr(event, 6), ts FROM events WHERE event LIKE 'kind:%';
+                """
+            )
+    # Индексы под агрегаты get_stats/get_detailed_stats (metrics(metric, value) — покрывающий для AVG/SUM).
+    # idx_events_event ни одним запросом не используется, а на каждой вставке в events обновлялся — удаляем
+    conn.executescript(
+        """
+        DROP INDEX IF EXISTS idx_events_event;
+        CREATE INDEX IF NOT EXISTS idx_events_user ON events(user_id);
+        CREATE INDEX IF NOT EXISTS idx_errors_code ON errors(code);
+        CREATE INDEX IF NOT EXISTS idx_metrics_metric ON metrics(metric, value);
+        CREATE INDEX IF NOT EXISTS idx_kinds_kind ON kinds(kind);
+        """
+    )
     return conn
 
 
-def record_event(user_id: int, event: str) -> None:
-    """Сохраняет событие в таблицу events (например, 'start', 'conversion')."""
+def _schedule_maintenance() -> None:
+    """Планирует следующий запуск _maintenance через _MAINTENANCE_INTERVAL_S."""
+    global _MAINTENANCE_TIMER
+    timer = threading.Timer(_MAINTENANCE_INTERVAL_S, _maintenance)
+    timer.daemon = True
+    timer.start()
+    _MAINTENANCE_TIMER = timer
+
+
+def _maintenance() -> None:
+    """Обновляет статистику планировщика и усекает WAL-файл, затем планирует следующий запуск."""
     try:
         conn = _get_conn()
-        conn.execute(
-            "INSERT INTO events(user_id, event, ts) VALUES (?, ?, ?);",
-            (user_id, event, int(time.time())),
-        )
-        conn.commit()
-    finally:
-        conn.close()
+        with _LOCK:
+            conn.execute("PRAGMA optimize;")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    except sqlite3.Error:
+        log.exception("Не удалось выполнить обслуживание БД аналитики")
+    _schedule_maintenance()
+
+
+def _close() -> None:
+    """Дописывает очередь и закрывает соединение при завершении процесса."""
+    if _MAINTENANCE_TIMER is not None:
+        _MAINTENANCE_TIMER.cancel()
+    writer = _WRITER
+    if writer is not None and writer.is_alive():
+        _WRITE_Q.put((_STOP, ()))
+        writer.join(timeout=5)
+    if _CONN is not None:
+        try:
+            _CONN.execute("PRAGMA optimize;")
+        except sqlite3.Error:
+            pass
+        _CONN.close()
+
+
+def _ensure_writer() -> None:
+    """Запускает фоновый поток записи при первом использовании."""
+    global _WRITER
+    if _WRITER is not None:
+        return
+    with _WRITER_LOCK:
+        if _WRITER is None:
+            _get_conn()
+            _WRITER = threading.Thread(target=_writer_loop, name="analytics-writer", daemon=True)
+            _WRITER.start()
+
+
+def _writer_loop() -> None:
+    """Забирает операции из очереди (до _WRITE_BATCH_MAX или за _WRITE_INTERVAL_S) и пишет их одним commit."""
+    conn = _get_conn()
+    while True:
+        batch = [_WRITE_Q.get()]
+        deadline = time.monotonic() + _WRITE_INTERVAL_S
+        while len(batch) < _WRITE_BATCH_MAX:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(_WRITE_Q.get(timeout=timeout))
+            except queue.Empty:
+                break
+        stop = any(op == _STOP for op, _ in batch)
+        items = [item for item in batch if item[0] != _STOP]
+        try:
+            _write_items(conn, items)
+        except sqlite3.Error:
+            # Пачка откатилась целиком — пишем операции по одной, чтобы одна плохая запись
+            # не потеряла остальные (в том числе других пользователей)
+            for item in items:
+                try:
+                    _write_items(conn, [item])
+                except sqlite3.Error:
+                    log.exception("Не удалось записать аналитику (операция %s)", item[0])
+        finally:
+            for _ in batch:
+                _WRITE_Q.task_done()
+        if stop:
+            return
+
+
+def _expand(items: List[tuple[str, tuple]]):
+    """Разворачивает составные операции в простые (операция, параметры)."""
+    for op, args in items:
+        if op == _MULTI:
+            yield from args
+        else:
+            yield op, args
+
+
+def _write_items(conn: sqlite3.Connection, items: List[tuple[str, tuple]]) -> None:
+    """Пишет операции одной транзакцией; при ошибке она откатывается целиком."""
+    with _LOCK, conn:
+        # Подряд идущие однотипные операции отправляем одним executemany
+        for op, group in itertools.groupby(_expand(items), key=lambda item: item[0]):
+            conn.executemany(_WRITE_OPS[op], [args for _, args in group])
+
+
+def _enqueue(op: str, args: tuple) -> None:
+    """Ставит операцию записи в очередь фонового потока."""
+    _ensure_writer()
+    _WRITE_Q.put_nowait((op, args))
+
+
+def record_event(user_id: int, event: str) -> None:
+    """Сохраняет событие в таблицу events (например, 'start', 'conversion')."""
+    _enqueue("event", (user_id, event, int(time.time())))
 
 
 def record_start(user_id: int) -> None:
@@ -74,61 +276,61 @@ def record_start(user_id: int) -> None:
     record_event(user_id, "start")
 
 
-def record_conversion(user_id: int) -> None:
-    """Учитывает успешную обработку видео (кружка)."""
-    try:
-        conn = _get_conn()
-        with conn:
-            conn.execute(
-                "INSERT INTO events(user_id, event, ts) VALUES (?, ?, ?);",
-                (user_id, "conversion", int(time.time())),
-            )
-            conn.execute(
-                """
-                INSERT INTO counters(user_id, processed_count) VALUES(?, 1)
-                ON CONFLICT(user_id) DO UPDATE SET processed_count = processed_count + 1;
-                """,
-                (user_id,),
-            )
-    finally:
-        conn.close()
-
 def record_error(user_id: int, code: str) -> None:
     """Учитывает ошибку обработки с коротким кодом."""
-    try:
-        conn = _get_conn()
-        conn.execute(
-            "INSERT INTO errors(user_id, code, ts) VALUES (?, ?, ?);",
-            (user_id, code, int(time.time())),
-        )
-        conn.commit()
-    finally:
-        conn.close()
+    _enqueue("error", (user_id, code, int(time.time())))
 
 def record_metric(user_id: int, metric: str, value: float) -> None:
     """Сохраняет числовую метрику (например, processing_ms, output_size_bytes)."""
-    try:
-        conn = _get_conn()
-        conn.execute(
-            "INSERT INTO metrics(user_id, metric, value, ts) VALUES (?, ?, ?, ?);",
-            (user_id, metric, value, int(time.time())),
-        )
-        conn.commit()
-    finally:
-        conn.close()
+    _enqueue("metric", (user_id, metric, value, int(time.time())))
+
 
 def record_kind(user_id: int, kind: str) -> None:
     """Фиксирует тип входного медиа (video | video_note | document)."""
-    record_event(user_id, f"kind:{kind}")
+    _enqueue("kind", (user_id, kind, int(time.time())))
+
+
+def record_processing_batch(
+    user_id: int,
+    kind: Optional[str],
+    processing_ms: Optional[float] = None,
+    output_size_bytes: Optional[float] = None,
+    error_code: Optional[str] = None,
+) -> None:
+    """Сохраняет итог обработки одного видео одной пачкой.
+
+    - kind: тип входного медиа (None — не записывать, например для ссылок)
+    - без error_code: событие conversion, счётчик и метрики processing_ms/output_size_bytes
+    - с error_code: только ошибка (обработка не засчитывается)
+    """
+    now = int(time.time())
+    ops: List[tuple[str, tuple]] = []
+    if kind:
+        ops.append(("kind", (user_id, kind, now)))
+    if error_code:
+        ops.append(("error", (user_id, error_code, now)))
+    else:
+        ops.append(("event", (user_id, "conversion", now)))
+        ops.append(("counter", (user_id,)))
+        # Метрики идут подряд — в фоновом потоке это один executemany
+        if processing_ms is not None:
+            ops.append(("metric", (user_id, "processing_ms", processing_ms, now)))
+        if output_size_bytes:
+            ops.append(("metric", (user_id, "output_size_bytes", output_size_bytes, now)))
+    # Одной составной операцией: записи об одном видео не разойдутся по разным транзакциям
+    _enqueue(_MULTI, tuple(ops))
 
 
 def get_stats() -> dict:
     """Возвращает словарь с агрегированной статистикой."""
     conn = _get_conn()
-    try:
+    with _LOCK:
         cur = conn.cursor()
-        # Всего уникальных пользователей (по любому событию)
-        cur.execute("SELECT COUNT(DISTINCT user_id) FROM events;")
+        # Всего уникальных пользователей (по любому событию или типу медиа: у отклонённых
+        # и неудавшихся загрузок событий нет, только запись в kinds)
+        cur.execute(
+            "SELECT COUNT(*) FROM (SELECT user_id FROM events UNION SELECT user_id FROM kinds);"
+        )
         total_users = cur.fetchone()[0] or 0
         # Всего обработок (сумма по counters)
         cur.execute("SELECT COALESCE(SUM(processed_count), 0) FROM counters;")
@@ -148,13 +350,11 @@ def get_stats() -> dict:
             "total_conversions": total_conversions,
             "top_users": top,  # List[Tuple[user_id, count]]
         }
-    finally:
-        conn.close()
 
 def get_detailed_stats() -> dict:
     """Расширенная статистика: ошибки, средняя длительность обработки, размеры и разбивка по типам медиа."""
     conn = _get_conn()
-    try:
+    with _LOCK:
         cur = conn.cursor()
         # Ошибки
         cur.execute("SELECT COUNT(*) FROM errors;")
@@ -170,15 +370,7 @@ def get_detailed_stats() -> dict:
         sum_bytes = row[0] or 0
         avg_bytes = row[1]
         # Разбивка по типам медиа
-        cur.execute(
-            """
-            SELECT substr(event, 6) AS kind, COUNT(*)
-            FROM events
-            WHERE event LIKE 'kind:%'
-            GROUP BY kind
-            ORDER BY COUNT(*) DESC;
-            """
-        )
+        cur.execute("SELECT kind, COUNT(*) FROM kinds GROUP BY kind ORDER BY 2 DESC;")
         kinds = cur.fetchall()
         return {
             "total_errors": total_errors,
@@ -188,7 +380,5 @@ def get_detailed_stats() -> dict:
             "avg_output_bytes": avg_bytes,
             "kinds": kinds,  # List[Tuple[kind, count]]
         }
-    finally:
-        conn.close()
 
 
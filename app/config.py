@@ -1,10 +1,34 @@
 from __future__ import annotations
 
+import functools
 import os
 from dataclasses import dataclass
 from pathlib import Path
 
-from dotenv import load_dotenv
+from dotenv import dotenv_values, load_dotenv
+
+# Переменные реального окружения процесса (systemd Environment=, docker -e): важнее .env —
+# и при старте, и при перечитывании по SIGHUP (reload_dotenv)
+_ENV_KEYS = frozenset(os.environ)
+# .env из текущей рабочей директории читается один раз при импорте — до модулей,
+# которые берут настройки из окружения на уровне модуля (handlers, analytics).
+# Уже заданные переменные окружения load_dotenv не перезаписывает.
+load_dotenv()
+# Ключи, чьи значения сейчас взяты из .env
+_dotenv_keys: set[str] = set(os.environ) - _ENV_KEYS
+
+
+def reload_dotenv() -> None:
+    """Перечитывает .env с тем же приоритетом, что при старте.
+    
+    Переменные реального окружения не перезаписываются; ключи, удалённые из .env, убираются из окружения.
+    """
+    values = {k: v for k, v in dotenv_values().items() if v is not None and k not in _ENV_KEYS}
+    for key in _dotenv_keys - values.keys():
+        os.environ.pop(key, None)
+    os.environ.update(values)
+    _dotenv_keys.clear()
+    _dotenv_keys.update(values)
 
 
 @dataclass(frozen=True)
@@ -17,14 +41,13 @@ class Settings:
     bot_token: str
 
 
+@functools.lru_cache(maxsize=1)
 def load_settings() -> Settings:
     """Загружает настройки из .env и переменных окружения.
     
-    Ищет файл .env в корне проекта (рабочей директории). Если файл отсутствует,
-    значения берутся из переменных окружения.
+    Файл .env (если есть) уже прочитан при импорте модуля; результат кэшируется
+    на процесс, повторные вызовы возвращают тот же экземпляр.
     """
-    # Загружаем .env из текущей рабочей директории
-    load_dotenv()
     token = os.getenv("BOT_TOKEN", "").strip()
     if not token:
         raise RuntimeError(
@@ -34,3 +57,138 @@ def load_settings() -> Settings:
     return Settings(bot_token=token)
 
 
+@dataclass(frozen=True)
+class FfmpegSettings:
+    """Параметры конвертации FFmpeg из переменных окружения.
+    
+    Attributes:
+        enhance: включена ли «подкрутка» цвета (ENHANCE_SAT).
+        sat: насыщенность для eq (VIDEO_NOTE_SAT).
+        con: контраст для eq (VIDEO_NOTE_CONTRAST).
+        bri: яркость для eq (VIDEO_NOTE_BRIGHTNESS).
+        gam: гамма для eq (VIDEO_NOTE_GAMMA).
+        timeout_s: таймаут одного прохода FFmpeg в секундах (FFMPEG_TIMEOUT_SECONDS).
+        size_limit_bytes: лимит размера «кружка» (TELEGRAM_VIDEONOTE_LIMIT_MB); 0 — без контроля.
+        preset: пресет libx264 (FFMPEG_PRESET).
+        scale_flags: флаги фильтра scale (SCALE_FLAGS).
+        hw_encoder: режим выбора аппаратного энкодера (FFMPEG_HW_ENCODER).
+        est_kbps: ожидаемый битрейт результата в CRF-режиме для прогноза превышения лимита
+            (VIDEO_NOTE_EST_KBPS).
+    """
+    enhance: bool
+    sat: float
+    con: float
+    bri: float
+    gam: float
+    timeout_s: int
+    size_limit_bytes: int
+    preset: str
+    scale_flags: str
+    hw_encoder: str
+    est_kbps: int
+
+
+@functools.lru_cache(maxsize=1)
+def load_ffmpeg_settings() -> FfmpegSettings:
+    """Разбирает переменные окружения FFmpeg один раз за процесс.
+    
+    Вызывается лениво при первой конвертации; .env загружен при импорте модуля.
+    """
+    try:
+        timeout_s = int(os.getenv("FFMPEG_TIMEOUT_SECONDS", "600"))
+    except Exception:
+        timeout_s = 600
+    try:
+        est_kbps = int(os.getenv("VIDEO_NOTE_EST_KBPS", "4000"))
+    except Exception:
+        est_kbps = 4000
+    limit_mb_env = os.getenv("TELEGRAM_VIDEONOTE_LIMIT_MB", "").strip()
+    try:
+        # 0 или отрицательное значение — отключает контроль размера
+        size_limit_mb = float(limit_mb_env) if limit_mb_env else 12.0
+    except Exception:
+        size_limit_mb = 12.0
+    return FfmpegSettings(
+        enhance=os.getenv("ENHANCE_SAT", "0").lower() in ("1", "true", "yes", "on"),
+        sat=float(os.getenv("VIDEO_NOTE_SAT", "1.12")),
+        con=float(os.getenv("VIDEO_NOTE_CONTRAST", "1.02")),
+        bri=float(os.getenv("VIDEO_NOTE_BRIGHTNESS", "0.0")),
+        gam=float(os.getenv("VIDEO_NOTE_GAMMA", "1.0")),
+        timeout_s=timeout_s,
+        size_limit_bytes=int(max(size_limit_mb, 0) * 1024 * 1024),
+        preset=os.getenv("FFMPEG_PRESET", "").strip() or "veryfast",
+        scale_flags=os.getenv("SCALE_FLAGS", "").strip() or "bicubic+accurate_rnd+full_chroma_int",
+        hw_encoder=os.getenv("FFMPEG_HW_ENCODER", "auto").strip().lower(),
+        est_kbps=est_kbps,
+    )
+
+
+@dataclass(frozen=True)
+class LimitSettings:
+    """Лимиты обработки сообщений из переменных окружения.
+    
+    Attributes:
+        max_video_duration_s: максимальная длительность видео (MAX_VIDEO_DURATION_SECONDS).
+        user_video_max_mb: лимит размера входного файла в МБ (USER_VIDEO_MAX_MB); 0 — без проверки.
+        user_video_max_bytes: тот же лимит в байтах.
+        http_download_max_bytes: лимит скачивания по ссылке (HTTP_DOWNLOAD_MAX_MB); 0 — без лимита.
+        max_concurrency: число одновременных задач (MAX_CONCURRENCY).
+        per_user_limit_s: за сколько секунд восстанавливается один жетон пользователя
+            (USER_RATE_LIMIT_SECONDS); 0 — без ограничения.
+        user_burst: запас жетонов пользователя (USER_RATE_BURST).
+        admin_id: Telegram ID администратора (ADMIN_ID); 0 — не задан.
+    """
+    max_video_duration_s: int
+    user_video_max_mb: float
+    user_video_max_bytes: int
+    http_download_max_bytes: int
+    max_concurrency: int
+    per_user_limit_s: float
+    user_burst: float
+    admin_id: int
+
+
+def load_limit_settings() -> LimitSettings:
+    """Разбирает лимиты обработки из переменных окружения.
+    
+    Не кэшируется: обработчики держат результат у себя и перечитывают его только по SIGHUP.
+    """
+    try:
+        max_duration_s = int(os.getenv("MAX_VIDEO_DURATION_SECONDS", "60"))
+    except Exception:
+        max_duration_s = 60
+    # 0 или <0 — отключить проверку
+    try:
+        user_limit_mb = max(float(os.getenv("USER_VIDEO_MAX_MB", "0")), 0.0)
+    except Exception:
+        user_limit_mb = 0.0
+    try:
+        http_max_mb = max(float(os.getenv("HTTP_DOWNLOAD_MAX_MB", "0")), 0.0)
+    except Exception:
+        http_max_mb = 0.0
+    try:
+        max_concurrency = int(os.getenv("MAX_CONCURRENCY", "2"))
+    except Exception:
+        max_concurrency = 2
+    try:
+        per_user_limit_s = float(os.getenv("USER_RATE_LIMIT_SECONDS", "20"))
+    except Exception:
+        per_user_limit_s = 20.0
+    try:
+        user_burst = max(1.0, float(os.getenv("USER_RATE_BURST", "2")))
+    except Exception:
+        user_burst = 2.0
+    try:
+        admin_id = int(os.getenv("ADMIN_ID", "0") or "0")
+    except Exception:
+        admin_id = 0
+    return LimitSettings(
+        max_video_duration_s=max_duration_s,
+        user_video_max_mb=user_limit_mb,
+        user_video_max_bytes=int(user_limit_mb * 1024 * 1024),
+        http_download_max_bytes=int(http_max_mb * 1024 * 1024),
+        max_concurrency=max_concurrency,
+        per_user_limit_s=per_user_limit_s,
+        user_burst=user_burst,
+        admin_id=admin_id,
+    )
@@ -1,38 +1,195 @@
 from __future__ import annotations
 
+import asyncio
+import functools
+import itertools
 import shutil
 import subprocess
 from pathlib import Path
-import json
-import os
-from typing import List, Optional
+import sys
+from typing import AsyncIterator, List, Optional
+
+from .config import load_ffmpeg_settings
+
+
+class DurationExceeded(RuntimeError):
+    """Длительность входного видео больше допустимой (проверяется в ходе конвертации)."""
+
+    def __init__(self, duration: int, limit: int) -> None:
+        super().__init__(f"Длительность видео {duration} сек превышает лимит {limit} сек.")
+        self.duration = duration
+        self.limit = limit
+
+
+# Аппаратные H.264-энкодеры в порядке предпочтения и их параметры качества (аналог CRF)
+_HW_ENCODER_ARGS = {
+    "h264_videotoolbox": ("-c:v", "h264_videotoolbox", "-q:v", "55", "-allow_sw", "1", "-profile:v", "baseline"),
+    "h264_nvenc": ("-c:v", "h264_nvenc", "-preset", "p5", "-rc", "vbr", "-cq", "23", "-b:v", "0", "-profile:v", "baseline"),
+    "h264_qsv": ("-c:v", "h264_qsv", "-preset", "medium", "-global_quality", "23", "-profile:v", "baseline"),
+}
+# Декодирование и масштабирование на том же устройстве, что и энкодер: кадры не копируются в RAM
+# (ключ — энкодер; значение — опции декодера и фильтр масштабирования, {size} — сторона квадрата)
+_HW_DEVICE_FILTERS = {
+    "h264_nvenc": (
+        ("-hwaccel", "cuda", "-hwaccel_output_format", "cuda"),
+        "scale_cuda=w={size}:h={size}:interp_algo=bicubic:format=yuv420p",
+    ),
+    "h264_videotoolbox": (
+        ("-hwaccel", "videotoolbox", "-hwaccel_output_format", "videotoolbox_vld"),
+        "scale_vt=w={size}:h={size}",
+    ),
+}
+# Неизменные части командной строки ffmpeg: собираются один раз при импорте,
+# в build_ffmpeg_command между ними вставляются только динамические аргументы
+_CMD_PREFIX = ("ffmpeg", "-y", "-hide_banner", "-loglevel", "error")  # -y: перезаписывать выход без запроса
+_FASTSTART = ("-movflags", "+faststart")
+_X264_COMPAT = ("-c:v", "libx264", "-profile:v", "baseline", "-level", "3.1")
+_X264_HIGH = ("-c:v", "libx264", "-profile:v", "high")
+# Аппаратное кодирование (пример для macOS). Обычно быстрее, но контроль качества иной.
+_VT_LEGACY = ("-c:v", "h264_videotoolbox", "-b:v", "2.5M")  # примерный видеобитрейт
+# Явные цветовые метаданные BT.709 + ограниченный диапазон
+_BT709_TAGS = ("-color_primaries", "bt709", "-color_trc", "bt709", "-colorspace", "bt709", "-color_range", "tv")
+# Аудио: либо копируем как есть, либо перекодируем в AAC без даунмикса
+_AUDIO_COPY = ("-c:a", "copy")
+_AUDIO_AAC = ("-c:a", "aac", "-b:a", "192k")
+# Битрейт звука, заложенный в бюджет размера при потолке видеобитрейта (max_kbps)
+_BUDGET_AUDIO_KBPS = 96
+# Энкодеры, которые прошли тестовое кодирование при старте, но потом отказали на входе,
+# который libx264 затем успешно обработал (проблема устройства, а не файла)
+_BROKEN_HW_ENCODERS: set[str] = set()
+# Энкодеры, для которых не заработала обработка кадров на устройстве (энкодер при этом может работать)
+_BROKEN_HW_FILTERS: set[str] = set()
+# Отказы декодирования/масштаба на устройстве подряд: один отказ может быть из-за самого входа
+# (кодек, который не умеет аппаратный декодер), поэтому отключаем путь только после нескольких подряд
+_hw_filter_failures: dict[str, int] = {}
+_HW_FILTER_MAX_FAILURES = 3
+# Форматы кадров, которые аппаратные декодеры принимают везде (8 бит, 4:2:0)
+_DEVICE_PIX_FMTS = ("yuv420p", "yuvj420p", "nv12")
+
+
+@functools.lru_cache(maxsize=1)
+def _ffmpeg_available() -> bool:
+    """Ищет ffmpeg в PATH один раз за процесс."""
+    return shutil.which("ffmpeg") is not None
 
 
 def ensure_ffmpeg_available() -> None:
-    """Проверяет наличие утилиты ffmpeg в системе.
+    """Проверяет наличие утилиты ffmpeg в системе (результат поиска кэшируется).
     
     Бросает исключение, если ffmpeg не найден в PATH.
     """
-    if shutil.which("ffmpeg") is None:
+    if not _ffmpeg_available():
         raise RuntimeError(
             "FFmpeg не найден. Установите FFmpeg и убедитесь, что он доступен в PATH. "
             "Например, на macOS: brew install ffmpeg"
         )
 
 
+@functools.lru_cache(maxsize=1)
+def _available_hw_encoders() -> tuple[str, ...]:
+    """Возвращает аппаратные H.264-энкодеры из `ffmpeg -encoders` (однократно за процесс).
+    
+    Вызывается лениво — при первой конвертации с FFMPEG_HW_ENCODER не none, а не при импорте.
+    """
+    if not _ffmpeg_available():
+        return ()
+    try:
+        out = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=10
+        ).stdout
+    except Exception:
+        return ()
+    names = {parts[1] for parts in (line.split() for line in out.splitlines()) if len(parts) > 1}
+    order = ["h264_videotoolbox"] if sys.platform == "darwin" else ["h264_nvenc", "h264_qsv"]
+    return tuple(name for name in order if name in names and _hw_encoder_works(name))
+
+
+def _hw_encoder_works(name: str) -> bool:
+    """Короткое тестовое кодирование синтетического видео (lavfi).
+    
+    Энкодер может быть в сборке ffmpeg без устройства или драйвера (например, apt-ffmpeg на CPU-сервере) —
+    такой отсеивается один раз при первом выборе энкодера, а не неудачными запусками на видео пользователей.
+    """
+    cmd = [
+        *_CMD_PREFIX,
+        "-f", "lavfi", "-i", "testsrc=size=256x256:rate=30:duration=0.2",
+        "-c:v", name,
+        "-f", "null", "-",
+    ]
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=15).returncode == 0
+    except Exception:
+        return False
+
+
+def _detect_hw_encoder() -> Optional[str]:
+    """Выбирает аппаратный энкодер согласно FFMPEG_HW_ENCODER.
+    
+    - auto (по умолчанию): первый доступный из h264_videotoolbox (macOS) / h264_nvenc / h264_qsv
+    - none/off/0: только libx264
+    - имя энкодера: использовать его, если он есть в сборке ffmpeg
+    """
+    mode = load_ffmpeg_settings().hw_encoder
+    if mode in ("", "none", "off", "0", "false", "no"):
+        return None
+    available = [name for name in _available_hw_encoders() if name not in _BROKEN_HW_ENCODERS]
+    if mode == "auto":
+        return available[0] if available else None
+    return mode if mode in available else None
+
+
+def _resolve_hw_encoder(hw_encoder: str | None) -> Optional[str]:
+    """Энкодер для конвертации: 'auto' — по FFMPEG_HW_ENCODER (_detect_hw_encoder), None — libx264,
+    имя — этот энкодер, если он есть в сборке и ещё не отказал на этой машине."""
+    if hw_encoder == "auto":
+        return _detect_hw_encoder()
+    if hw_encoder and hw_encoder in _available_hw_encoders() and hw_encoder not in _BROKEN_HW_ENCODERS:
+        return hw_encoder
+    return None
+
+
+def _is_hdr(source_colors: dict | None) -> bool:
+    """Определяет HDR-источник (HLG/PQ или BT.2020) по цветовым метаданным ffprobe."""
+    if not source_colors:
+        return False
+    prim = (source_colors.get("color_primaries") or "").lower()
+    trc = (source_colors.get("color_transfer") or "").lower()
+    mtx = (source_colors.get("color_space") or "").lower()
+    return trc in ("arib-std-b67", "smpte2084") or "2020" in prim or "2020" in mtx
+
+
+def _can_filter_on_device(
+    hw_encoder: str | None,
+    source_colors: dict | None,
+    enhance_saturation: bool,
+    force_limited_range: bool,
+) -> bool:
+    """Можно ли выполнить кроп и масштаб на GPU: тонемаппинг, eq и colorspace есть только на CPU."""
+    return (
+        hw_encoder in _HW_DEVICE_FILTERS
+        and hw_encoder not in _BROKEN_HW_FILTERS
+        and not _is_hdr(source_colors)
+        # 10-битные и 4:2:2/4:4:4 входы аппаратные декодеры принимают не всегда — их кадры готовим на CPU
+        and (source_colors or {}).get("pix_fmt") in _DEVICE_PIX_FMTS
+        and not enhance_saturation
+        and not force_limited_range
+    )
+
+
 def build_ffmpeg_command(
     input_path: Path,
     output_path: Path,
     size: int = 640,
     use_hwaccel: bool = False,
     crf: int = 14,
-    preset: str = "slow",
+    preset: str = "veryfast",
     audio_codec: str = "copy",
+    audio_kbps: int | None = None,
     source_colors: dict | None = None,
     auto_colorspace: bool = False,
     tune: str | None = None,
     apply_color_tags: bool = False,
-    scale_flags: str = "lanczos+accurate_rnd+full_chroma_int",
+    scale_flags: str = "bicubic+accurate_rnd+full_chroma_int",
     compat_video_note: bool = True,
     enhance_saturation: bool = False,
     saturation: float = 1.0,
@@ -40,11 +197,16 @@ def build_ffmpeg_command(
     brightness: float = 0.0,
     gamma: float = 1.0,
     force_limited_range: bool = False,
+    hw_encoder: str | None = None,
+    hw_filters: bool = False,
+    max_kbps: int | None = None,
+    max_duration_s: int | None = None,
 ) -> List[str]:
     """Строит команду ffmpeg для конвертации видео в квадратный формат.
     
     - Кроп до квадрата (по меньшей стороне), затем масштаб до size x size
-    - Масштабирование: высококачественное (lanczos) с точной обработкой хромы
+    - Масштабирование: bicubic с точной обработкой хромы (lanczos заметно медленнее, а при
+      уменьшении 1080p → 640 разница почти не видна; вернуть можно через SCALE_FLAGS)
     - Видео: H.264 (libx264 по умолчанию) с CRF, yuv420p для совместимости
     - Аудио: по умолчанию копируем исходный поток (макс. качество); при несовместимости используем AAC
     - Добавлен -movflags +faststart для более быстрой отправки
@@ -56,13 +218,19 @@ def build_ffmpeg_command(
         size: целевой размер стороны квадрата (по умолчанию 640)
         use_hwaccel: использовать ли аппаратное кодирование (опционально)
         crf: целевой CRF для libx264 (меньше — лучше качество/больше размер)
-        preset: пресет скорости для libx264
+        preset: пресет скорости для libx264 (veryfast — быстрый ответ; slow — режим «качество»)
         audio_codec: 'copy' для копирования звука или 'aac' для перекодирования
+        audio_kbps: битрейт AAC (по умолчанию 192k); задаётся вместе с max_kbps — под него считан бюджет
         source_colors: словарь цветовых метаданных входа (ffprobe)
         auto_colorspace: автоматически конвертировать в bt709 при отличии исходного пространства
         tune: подсказка кодеку (например, 'film' или 'grain') для визуального качества
         apply_color_tags: проставлять ли цветовые теги BT.709 в выходном видео
-        scale_flags: флаги для фильтра scale (качество ресемплинга)
+        scale_flags: флаги для фильтра scale (качество/скорость ресемплинга, например lanczos или spline)
+        hw_encoder: аппаратный энкодер (h264_videotoolbox | h264_nvenc | h264_qsv) вместо libx264
+        hw_filters: декодировать, кропать и масштабировать на устройстве энкодера (CUDA/VideoToolbox),
+            если цепочке не нужны CPU-фильтры (см. _can_filter_on_device)
+        max_kbps: потолок видеобитрейта (-maxrate/-bufsize), когда результат иначе не уложится в лимит размера
+        max_duration_s: лимит длительности; выход обрезается по -t (с запасом 1 сек), если вход длиннее
     
     Примечание:
         Для macOS можно попробовать аппаратное кодирование:
@@ -74,7 +242,10 @@ def build_ffmpeg_command(
     prim = (source_colors.get("color_primaries") or "").lower() if source_colors else ""
     trc = (source_colors.get("color_transfer") or "").lower() if source_colors else ""
     mtx = (source_colors.get("color_space") or "").lower() if source_colors else ""
-    is_hdr = trc in ("arib-std-b67", "smpte2084") or "2020" in prim or "2020" in mtx
+    is_hdr = _is_hdr(source_colors)
+    on_device = hw_filters and _can_filter_on_device(
+        hw_encoder, source_colors, enhance_saturation, force_limited_range
+    )
     # Для HDR (HLG/PQ, BT.2020) используем тонемаппинг в SDR BT.709 перед масштабированием
     if is_hdr:
         prim_in = "bt2020" if "2020" in prim else (prim or "bt709")
@@ -103,206 +274,150 @@ def build_ffmpeg_command(
             f"gamma={max(0.1, gamma):.3f}",
         ]
         vf_chain.append("eq=" + ":".join(eq_parts))
-    # Итоговый формат пикселей для совместимости с Telegram
-    vf_chain.append("format=yuv420p")
+    # Итоговый формат пикселей для совместимости с Telegram (QSV принимает только nv12 — тот же 4:2:0)
+    vf_chain.append("format=nv12" if hw_encoder == "h264_qsv" else "format=yuv420p")
     # Для максимальной совместимости video note на мобильных не проставляем цветовые теги
     if not compat_video_note and apply_color_tags:
         vf_chain.append("setparams=range=tv:color_primaries=bt709:color_trc=bt709:colorspace=bt709")
-    scale_crop = ",".join(vf_chain)
-    cmd = [
-        "ffmpeg",
-        "-y",  # перезаписывать выходной файл без запроса
-        "-hide_banner",
-        "-loglevel", "error",
-        "-i", str(input_path),
-        "-vf", scale_crop,
-        "-movflags", "+faststart",
-    ]
-    if use_hwaccel:
-        # Аппаратное кодирование (пример для macOS). Обычно быстрее, но контроль качества иной.
-        cmd += [
-            "-c:v", "h264_videotoolbox",
-            "-b:v", "2.5M",  # примерный видеобитрейт
-        ]
-    else:
-        # Программное кодирование libx264 с CRF
-        if compat_video_note:
-            # Максимальная совместимость с мобильными клиентами Telegram
-            cmd += [
-                "-c:v", "libx264",
-                "-profile:v", "baseline",
-                "-level", "3.1",
-                "-preset", preset,
-                "-crf", str(crf),
-            ]
-            if tune:
-                cmd += ["-tune", tune]
-            # Явные цветовые метаданные BT.709 + ограниченный диапазон
-            if force_limited_range:
-                cmd += [
-                    "-color_primaries", "bt709",
-                    "-color_trc", "bt709",
-                    "-colorspace", "bt709",
-                    "-color_range", "tv",
-                ]
-        else:
-            cmd += [
-                "-c:v", "libx264",
-                "-profile:v", "high",
-                "-preset", preset,
-                "-crf", str(crf),
-            ]
-            if tune:
-                cmd += ["-tune", tune]
-            if force_limited_range:
-                cmd += [
-                    "-color_primaries", "bt709",
-                    "-color_trc", "bt709",
-                    "-colorspace", "bt709",
-                    "-color_range", "tv",
-                ]
-    # Аудио: либо копируем как есть, либо перекодируем в AAC без даунмикса
-    if audio_codec == "copy":
-        cmd += ["-c:a", "copy"]
+    input_args: tuple = ()
+    if on_device:
+        # Кадры остаются в памяти GPU: кроп (метаданные кадра) → масштаб на устройстве → энкодер
+        input_args, device_scale = _HW_DEVICE_FILTERS[hw_encoder]
+        vf_chain = [vf_chain[0], device_scale.format(size=size), "setsar=1"]
+    if hw_encoder:
+        # Аппаратный энкодер с режимом постоянного качества; фильтры остаются те же
+        video_args: tuple = _HW_ENCODER_ARGS[hw_encoder]
+    elif use_hwaccel:
+        video_args = _VT_LEGACY
     else:
-        cmd += ["-c:a", "aac", "-b:a", "192k"]
-    cmd += [str(output_path)]
+        # Программное кодирование libx264 с CRF; baseline — максимальная совместимость с мобильными клиентами Telegram
+        video_args = (
+            *(_X264_COMPAT if compat_video_note else _X264_HIGH),
+            "-preset", preset,
+            "-crf", str(crf),
+            *(("-tune", tune) if tune else ()),
+            *(_BT709_TAGS if force_limited_range else ()),
+        )
+    return list(itertools.chain(
+        _CMD_PREFIX,
+        input_args,
+        ("-i", str(input_path), "-vf", ",".join(vf_chain)),
+        _FASTSTART,
+        video_args,
+        ("-maxrate", f"{max_kbps}k", "-bufsize", f"{max_kbps * 2}k") if max_kbps else (),
+        ("-t", str(max_duration_s + 1)) if max_duration_s else (),
+        _AUDIO_COPY if audio_codec == "copy" else (
+            ("-c:a", "aac", "-b:a", f"{audio_kbps}k") if audio_kbps else _AUDIO_AAC
+        ),
+        (str(output_path),),
+    ))
+
+
+def build_ffmpeg_command_stdin(output_path: Path, **kwargs) -> List[str]:
+    """То же, что build_ffmpeg_command, но вход читается из stdin (-i pipe:0)."""
+    cmd = build_ffmpeg_command(input_path=Path("pipe:0"), output_path=output_path, **kwargs)
+    cmd[cmd.index("-i") + 1] = "pipe:0"
     return cmd
 
 
-def probe_source_colorspace(input_path: Path) -> dict:
-    """Опрашивает ffprobe, чтобы получить color_space/transfer/primaries у входного видео.
+def _note_hw_outcome(
+    hw_encoder: Optional[str],
+    attempts: List[tuple[Optional[str], bool]],
+    failed: List[tuple[str, bool]],
+) -> None:
+    """Учитывает итог аппаратных попыток успешной конвертации (вызывается, только если какая-то попытка прошла)."""
+    for encoder, on_device in failed:
+        if on_device:
+            count = _hw_filter_failures.get(encoder, 0) + 1
+            _hw_filter_failures[encoder] = count
+            if count >= _HW_FILTER_MAX_FAILURES:
+                # Декодирование/масштаб на устройстве не работают — дальше только CPU-фильтры
+                _BROKEN_HW_FILTERS.add(encoder)
+        else:
+            # Энкодер отказал, а libx264 на том же входе справился — больше не пробуем его
+            _BROKEN_HW_ENCODERS.add(encoder)
+    if hw_encoder and (hw_encoder, True) in attempts and (hw_encoder, True) not in failed:
+        _hw_filter_failures.pop(hw_encoder, None)
+
+
+def _probe_source(path: Path) -> dict:
+    """Один вызов ffprobe на файл: цветовые метаданные первого видеопотока и длительность.
     
-    Возвращает словарь с ключами color_space, color_transfer, color_primaries (если доступны).
+    Возвращает словарь с ключами color_space, color_transfer, color_primaries, pix_fmt, duration
+    (те, что удалось получить). Результат кэшируется по (путь, mtime, размер).
     """
+    try:
+        st = path.stat()
+    except OSError:
+        return {}
+    return dict(_probe_source_cached(str(path), st.st_mtime_ns, st.st_size))
+
+
+@functools.lru_cache(maxsize=64)
+def _probe_source_cached(path: str, mtime_ns: int, size: int) -> dict:
+    """Запускает ffprobe; mtime_ns и size входят в ключ кэша, чтобы изменённый файл опрашивался заново."""
     cmd = [
         "ffprobe",
         "-v", "error",
         "-select_streams", "v:0",
-        "-show_entries", "stream=color_space,color_transfer,color_primaries",
-        "-of", "json",
-        str(input_path),
+        "-show_entries", "stream=color_space,color_transfer,color_primaries,pix_fmt:format=duration",
+        # key=value по строке на поле: без JSON-парсера и без зависимости от порядка/пропуска полей,
+        # как в csv (ffprobe опускает неизвестные значения)
+        "-of", "default=noprint_wrappers=1",
+        path,
     ]
+    info: dict = {}
     try:
         result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        data = json.loads(result.stdout or "{}")
-        streams = data.get("streams") or []
-        if streams:
-            s = streams[0]
-            return {
-                "color_space": s.get("color_space"),
-                "color_transfer": s.get("color_transfer"),
-                "color_primaries": s.get("color_primaries"),
-            }
+        for line in (result.stdout or "").splitlines():
+            key, sep, value = line.partition("=")
+            if not sep or not value or value in ("unknown", "N/A"):
+                continue
+            if key == "duration":
+                info["duration"] = float(value)
+            elif key in ("color_space", "color_transfer", "color_primaries", "pix_fmt"):
+                info.setdefault(key, value)
     except Exception:
         pass
-    return {}
+    return info
 
 
-def convert_to_square_video_note(
-    input_path: Path,
+def _video_kbps_for_limit(size_limit_bytes: int, duration: float, audio_k: int = 96) -> int:
+    """Видеобитрейт (кбит/с), при котором ролик длительностью duration уложится в лимит размера."""
+    # Резерв 95% лимита под полезные данные
+    target_bits_total = int(size_limit_bytes * 8 * 0.95)
+    if duration > 0:
+        return max(300, int(target_bits_total / duration / 1000) - audio_k)
+    return 1800
+
+
+async def _enforce_size_limit(
     output_path: Path,
-    size: int = 640,
-    use_hwaccel: bool = False,
-    crf: int = 18,
-    preset: str = "slow",
+    source_duration: Optional[float],
+    crf: int,
+    ffmpeg_timeout_s: int,
 ) -> None:
-    """Запускает ffmpeg-конвертацию в квадратный формат для видео-заметки.
+    """Перекодирует результат с ограничением битрейта, если он больше TELEGRAM_VIDEONOTE_LIMIT_MB.
     
-    Бросает RuntimeError при неудаче, включая stderr ffmpeg.
+    source_duration — длительность входа (если известна), чтобы не запускать лишний ffprobe.
     """
-    ensure_ffmpeg_available()
-    source_colors = probe_source_colorspace(input_path)
-    # Опциональная «подкрутка» цвета из .env (по умолчанию выключена)
-    enhance = os.getenv("ENHANCE_SAT", "0").lower() in ("1", "true", "yes", "on")
-    sat = float(os.getenv("VIDEO_NOTE_SAT", "1.12"))
-    con = float(os.getenv("VIDEO_NOTE_CONTRAST", "1.02"))
-    bri = float(os.getenv("VIDEO_NOTE_BRIGHTNESS", "0.0"))
-    gam = float(os.getenv("VIDEO_NOTE_GAMMA", "1.0"))
-    # 1-я попытка: копировать аудио для максимального качества/скорости
-    cmd = build_ffmpeg_command(
-        input_path=input_path,
-        output_path=output_path,
-        size=size,
-        use_hwaccel=use_hwaccel,
-        crf=crf,
-        preset=preset,
-        source_colors=source_colors,
-        auto_colorspace=False,  # отключаем автоматическую конверсию цветов для совместимости
-        audio_codec="copy",
-        compat_video_note=True,
-        enhance_saturation=enhance,
-        saturation=sat,
-        contrast=con,
-        brightness=bri,
-        gamma=gam,
-    )
-    # Таймаут FFmpeg из .env (по умолчанию 600 сек)
-    try:
-        ffmpeg_timeout_s = int(os.getenv("FFMPEG_TIMEOUT_SECONDS", "600"))
-    except Exception:
-        ffmpeg_timeout_s = 600
-    try:
-        proc = subprocess.run(cmd, capture_output=True, text=True, timeout=ffmpeg_timeout_s)
-    except subprocess.TimeoutExpired:
-        raise RuntimeError(f"Обработка видео превысила лимит времени {ffmpeg_timeout_s} сек и была прервана.")
-    if proc.returncode != 0:
-        # Если копирование звука несовместимо с mp4 (например, opus), то повторим с AAC
-        cmd_fallback = build_ffmpeg_command(
-            input_path=input_path,
-            output_path=output_path,
-            size=size,
-            use_hwaccel=use_hwaccel,
-            crf=crf,
-            preset=preset,
-            source_colors=source_colors,
-            auto_colorspace=False,
-            audio_codec="aac",
-            compat_video_note=True,
-            enhance_saturation=enhance,
-            saturation=sat,
-            contrast=con,
-            brightness=bri,
-            gamma=gam,
-        )
-        try:
-            proc2 = subprocess.run(cmd_fallback, capture_output=True, text=True, timeout=ffmpeg_timeout_s)
-        except subprocess.TimeoutExpired:
-            raise RuntimeError(f"Обработка видео (fallback) превысила лимит времени {ffmpeg_timeout_s} сек и была прервана.")
-        if proc2.returncode != 0:
-            raise RuntimeError(f"FFmpeg ошибка:\n{proc2.stderr.strip()}")
-
     # Гарантируем укладывание в лимит размера для video note
-    limit_mb_env = os.getenv("TELEGRAM_VIDEONOTE_LIMIT_MB", "").strip()
-    try:
-        # 0 или отрицательное значение — отключает контроль размера
-        size_limit_mb = float(limit_mb_env) if limit_mb_env else 12.0
-    except Exception:
-        size_limit_mb = 12.0
-    if size_limit_mb <= 0:
+    size_limit_bytes = load_ffmpeg_settings().size_limit_bytes
+    if size_limit_bytes <= 0:
         # Без ограничения: не трогаем результат, отправляем как есть
         return
-    size_limit_bytes = int(size_limit_mb * 1024 * 1024)
     try:
         out_size = output_path.stat().st_size
     except FileNotFoundError:
         out_size = 0
     if out_size > size_limit_bytes:
-        # Перекодируем с расчётом целевого битрейта
-        duration = _probe_duration_seconds(output_path) or _probe_duration_seconds(input_path) or 0.0
-        # Резерв 95% лимита под полезные данные
-        target_bits_total = int(size_limit_bytes * 8 * 0.95)
+        # Перекодируем с расчётом целевого битрейта (длительность входа уже известна — без лишнего ffprobe)
+        duration = source_duration or await asyncio.to_thread(_probe_duration_seconds, output_path) or 0.0
         audio_k = 96
-        if duration > 0:
-            v_k = max(300, int(target_bits_total / duration / 1000) - audio_k)
-        else:
-            v_k = 1800
+        v_k = _video_kbps_for_limit(size_limit_bytes, duration, audio_k)
         tmp_path = output_path.with_suffix(".sizefix.mp4")
         cmd_reduce = [
-            "ffmpeg",
-            "-y",
-            "-hide_banner",
-            "-loglevel", "error",
+            *_CMD_PREFIX,
             "-i", str(output_path),
             "-r", "24",
             "-c:v", "libx264",
@@ -318,31 +433,260 @@ def convert_to_square_video_note(
             str(tmp_path),
         ]
         try:
-            proc3 = subprocess.run(cmd_reduce, capture_output=True, text=True, timeout=ffmpeg_timeout_s)
-        except subprocess.TimeoutExpired:
+            returncode, stderr = await _run_ffmpeg(cmd_reduce, ffmpeg_timeout_s)
+        except asyncio.TimeoutError:
             raise RuntimeError(f"Обработка видео (size-fix) превысила лимит времени {ffmpeg_timeout_s} сек и была прервана.")
-        if proc3.returncode != 0:
-            raise RuntimeError(f"FFmpeg ошибка (size-fix):\n{proc3.stderr.strip()}")
+        if returncode != 0:
+            raise RuntimeError(f"FFmpeg ошибка (size-fix):\n{stderr.strip()}")
         # Заменяем файл результатом перекодирования
         output_path.unlink(missing_ok=True)
         tmp_path.rename(output_path)
 
+
+async def _run_ffmpeg(cmd: List[str], timeout_s: float) -> tuple[int, str]:
+    """Запускает процесс без блокировки event loop и возвращает (код возврата, stderr).
+    
+    Бросает asyncio.TimeoutError по истечении timeout_s; процесс при этом (и при отмене задачи) убивается.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        _, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout_s)
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    return proc.returncode, (stderr or b"").decode(errors="replace")
+
+
+async def convert_to_square_video_note(
+    input_path: Path,
+    output_path: Path,
+    size: int = 640,
+    use_hwaccel: bool = False,
+    crf: int = 18,
+    preset: str | None = None,
+    max_duration_s: int | None = None,
+    hw_encoder: str | None = "auto",
+) -> None:
+    """Запускает ffmpeg-конвертацию в квадратный формат для видео-заметки (асинхронно, без потоков).
+    
+    preset по умолчанию берётся из FFMPEG_PRESET (veryfast); slow даёт чуть меньший файл
+    ценой многократно более долгого кодирования (лимит размера контролируется отдельно).
+    max_duration_s: лимит длительности — проверяется по тому же ffprobe, что нужен для цвета,
+    отдельная проверка до конвертации не требуется.
+    hw_encoder: 'auto' (аппаратный энкодер, найденный при импорте), None (libx264) или имя энкодера;
+    если аппаратный энкодер не запускается, конвертация повторяется на libx264.
+    
+    Бросает DurationExceeded, если вход длиннее max_duration_s, и RuntimeError при неудаче ffmpeg.
+    """
+    ensure_ffmpeg_available()
+    cfg = load_ffmpeg_settings()
+    if preset is None:
+        preset = cfg.preset
+    # Один ffprobe на входной файл: цвет для фильтров, длительность для лимитов длительности и размера
+    source_info = await asyncio.to_thread(_probe_source, input_path)
+    source_colors = {
+        k: source_info[k] for k in ("color_space", "color_transfer", "color_primaries", "pix_fmt") if k in source_info
+    }
+    duration = source_info.get("duration")
+    if max_duration_s and duration and int(duration) > max_duration_s:
+        raise DurationExceeded(int(duration), max_duration_s)
+    # Опциональная «подкрутка» цвета из .env (по умолчанию выключена)
+    enhance = cfg.enhance
+    ffmpeg_timeout_s = cfg.timeout_s
+    # Если по длительности и типичному битрейту результат заведомо не уложится в лимит размера,
+    # сразу кодируем с потолком битрейта — без второго полного прохода size-fix
+    max_kbps = None
+    if cfg.size_limit_bytes > 0 and duration and duration * cfg.est_kbps * 1000 > cfg.size_limit_bytes * 8 * 0.95:
+        max_kbps = _video_kbps_for_limit(cfg.size_limit_bytes, duration, _BUDGET_AUDIO_KBPS)
+        crf = max(crf, 22)
+    # Аппаратный энкодер (если найден): сначала с фильтрами на устройстве, затем с CPU-фильтрами;
+    # при ошибке откатываемся на libx264
+    # При первом вызове — ffmpeg -encoders и тестовые кодирования, поэтому в отдельном потоке
+    hw_encoder = None if use_hwaccel else await asyncio.to_thread(_resolve_hw_encoder, hw_encoder)
+    attempts: List[tuple[Optional[str], bool]] = []
+    # Неудавшиеся аппаратные попытки: в «сломанные» попадают, только если следующая попытка
+    # на том же входе прошла — иначе виноват сам файл (битая загрузка и т.п.), а не устройство
+    failed: List[tuple[str, bool]] = []
+    if hw_encoder:
+        if _can_filter_on_device(hw_encoder, source_colors, enhance, False):
+            attempts.append((hw_encoder, True))
+        attempts.append((hw_encoder, False))
+    attempts.append((None, False))
+    for encoder, on_device in attempts:
+        # 1-я попытка: копировать аудио для максимального качества/скорости. С потолком битрейта звук
+        # сразу перекодируем в AAC _BUDGET_AUDIO_KBPS: копия исходной дорожки не уложится в бюджет max_kbps
+        if max_kbps is None:
+            cmd = build_ffmpeg_command(
+                input_path=input_path,
+                output_path=output_path,
+                size=size,
+                use_hwaccel=use_hwaccel,
+                crf=crf,
+                preset=preset,
+                source_colors=source_colors,
+                auto_colorspace=False,  # отключаем автоматическую конверсию цветов для совместимости
+                audio_codec="copy",
+                compat_video_note=True,
+                enhance_saturation=enhance,
+                saturation=cfg.sat,
+                contrast=cfg.con,
+                brightness=cfg.bri,
+                gamma=cfg.gam,
+                scale_flags=cfg.scale_flags,
+                hw_encoder=encoder,
+                hw_filters=on_device,
+                max_kbps=max_kbps,
+                max_duration_s=max_duration_s,
+            )
+            try:
+                returncode, _ = await _run_ffmpeg(cmd, ffmpeg_timeout_s)
+            except asyncio.TimeoutError:
+                raise RuntimeError(f"Обработка видео превысила лимит времени {ffmpeg_timeout_s} сек и была прервана.")
+            if returncode == 0:
+                break
+        # Если копирование звука несовместимо с mp4 (например, opus), то повторим с AAC
+        cmd_fallback = build_ffmpeg_command(
+            input_path=input_path,
+            output_path=output_path,
+            size=size,
+            use_hwaccel=use_hwaccel,
+            crf=crf,
+            preset=preset,
+            source_colors=source_colors,
+            auto_colorspace=False,
+            audio_codec="aac",
+            audio_kbps=_BUDGET_AUDIO_KBPS if max_kbps else None,
+            compat_video_note=True,
+            enhance_saturation=enhance,
+            saturation=cfg.sat,
+            contrast=cfg.con,
+            brightness=cfg.bri,
+            gamma=cfg.gam,
+            scale_flags=cfg.scale_flags,
+            hw_encoder=encoder,
+            hw_filters=on_device,
+            max_kbps=max_kbps,
+            max_duration_s=max_duration_s,
+        )
+        try:
+            returncode, stderr = await _run_ffmpeg(cmd_fallback, ffmpeg_timeout_s)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"Обработка видео (fallback) превысила лимит времени {ffmpeg_timeout_s} сек и была прервана.")
+        if returncode == 0:
+            break
+        if encoder:
+            failed.append((encoder, on_device))
+            continue
+        raise RuntimeError(f"FFmpeg ошибка:\n{stderr.strip()}")
+    _note_hw_outcome(hw_encoder, attempts, failed)
+
+    await _enforce_size_limit(output_path, duration, crf, ffmpeg_timeout_s)
+
+
+async def convert_stream_to_square_video_note(
+    chunks: AsyncIterator[bytes],
+    mirror_path: Path,
+    output_path: Path,
+    size: int = 640,
+    crf: int = 18,
+    preset: str | None = None,
+    max_duration_s: int | None = None,
+    hw_encoder: str | None = "auto",
+) -> None:
+    """Конвертирует видео, подавая скачиваемые байты прямо в stdin ffmpeg (-i pipe:0).
+    
+    Скачивание и кодирование идут одновременно. Байты параллельно сохраняются в mirror_path:
+    если из трубы файл не читается (например, mp4 с moov-атомом в конце) или вход оказался HDR
+    (цветовые метаданные до начала кодирования неизвестны), выполняется обычная конвертация из файла.
+    
+    Бросает DurationExceeded или RuntimeError, как convert_to_square_video_note.
+    """
+    ensure_ffmpeg_available()
+    cfg = load_ffmpeg_settings()
+    if preset is None:
+        preset = cfg.preset
+    ffmpeg_timeout_s = cfg.timeout_s
+    hw_encoder = await asyncio.to_thread(_resolve_hw_encoder, hw_encoder)
+    cmd = build_ffmpeg_command_stdin(
+        output_path=output_path,
+        size=size,
+        crf=crf,
+        preset=preset,
+        audio_codec="copy",
+        compat_video_note=True,
+        enhance_saturation=cfg.enhance,
+        saturation=cfg.sat,
+        contrast=cfg.con,
+        brightness=cfg.bri,
+        gamma=cfg.gam,
+        scale_flags=cfg.scale_flags,
+        hw_encoder=hw_encoder,
+        max_duration_s=max_duration_s,
+    )
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    # stderr читаем параллельно, иначе заполненный буфер трубы остановит ffmpeg
+    stderr_task = asyncio.create_task(proc.stderr.read())
+    try:
+        pipe_open = True
+        # Работа с файлом копии — в отдельном потоке: запись на медленный диск не держит event loop
+        mirror = await asyncio.to_thread(mirror_path.open, "wb")
+        try:
+            async for chunk in chunks:
+                await asyncio.to_thread(mirror.write, chunk)
+                if not pipe_open:
+                    continue
+                try:
+                    proc.stdin.write(chunk)
+                    await proc.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    # ffmpeg завершился раньше — докачиваем файл для повторной попытки
+                    pipe_open = False
+        finally:
+            await asyncio.to_thread(mirror.close)
+        if pipe_open:
+            proc.stdin.close()
+        try:
+            await asyncio.wait_for(proc.wait(), timeout=ffmpeg_timeout_s)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"Обработка видео превысила лимит времени {ffmpeg_timeout_s} сек и была прервана.")
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        await stderr_task
+    source_info = await asyncio.to_thread(_probe_source, mirror_path)
+    duration = source_info.get("duration")
+    if max_duration_s and duration and int(duration) > max_duration_s:
+        raise DurationExceeded(int(duration), max_duration_s)
+    if proc.returncode != 0 or _is_hdr(source_info):
+        await convert_to_square_video_note(
+            mirror_path, output_path, size, crf=crf, preset=preset, max_duration_s=max_duration_s, hw_encoder=hw_encoder
+        )
+        return
+    await _enforce_size_limit(output_path, source_info.get("duration"), crf, ffmpeg_timeout_s)
+
+
 def _probe_duration_seconds(path: Path) -> Optional[float]:
     """Возвращает длительность файла в секундах через ffprobe, либо None при ошибке.
     
-    Используется для документов (video как файл), где Telegram не указывает duration.
+    Используется, когда длительность входа неизвестна (например, для контроля размера результата).
+    Результат берётся из общего с цветовыми метаданными вызова ffprobe (_probe_source).
     """
-    cmd = [
-        "ffprobe",
-        "-v", "error",
-        "-show_entries", "format=duration",
-        "-of", "default=noprint_wrappers=1:nokey=1",
-        str(path),
-    ]
-    try:
-        out = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        s = (out.stdout or "").strip()
-        return float(s) if s else None
-    except Exception:
-        return None
+    return _probe_source(path).get("duration")
+
 
+# Наличие ffmpeg проверяем один раз при импорте, а не на каждое видео; аппаратные энкодеры —
+# лениво (_resolve_hw_encoder): с FFMPEG_HW_ENCODER=none тестовые кодирования не запускаются вовсе
+_ffmpeg_available()
@@ -1,66 +1,335 @@
 from __future__ import annotations
 
 import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import hashlib
+import heapq
+import itertools
+import logging
+import math
 from pathlib import Path
+import shutil
 import time
-from tempfile import TemporaryDirectory
-from typing import Optional, Tuple
+import tempfile
+from typing import AsyncIterator, Optional, Tuple
 import os
 import re
-from urllib.parse import urlparse
+from urllib.parse import urldefrag, urlparse
 
 from aiogram import F, Router
-from aiogram.filters import CommandStart
-from aiogram.types import FSInputFile, Message
+from aiogram.filters import CommandObject, CommandStart
+from aiogram.types import Document, FSInputFile, Message, Video, VideoNote
 from aiogram.utils.chat_action import ChatActionSender
 from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramAPIError
 import aiohttp
 
-from .ffmpeg_utils import convert_to_square_video_note, _probe_duration_seconds
+from .config import LimitSettings, load_limit_settings, reload_dotenv
+from .ffmpeg_utils import (
+    convert_to_square_video_note,
+    convert_stream_to_square_video_note,
+    DurationExceeded,
+)
 from .analytics import (
     record_start,
-    record_conversion,
     get_stats,
     record_error,
-    record_metric,
     record_kind,
+    record_processing_batch,
     get_detailed_stats,
 )
 from aiogram.filters import Command
 
 router = Router(name="media_handlers")
+log = logging.getLogger(__name__)
+
+# Всё состояние модуля ниже (словари анти-дубля, корзины, кэши) меняется только из потока event loop,
+# без await между чтением и записью, поэтому дополнительные блокировки не нужны — кроме per-user Lock,
+# которые сериализуют проверки, разорванные await
+
+# Классификация текстов ошибок одним скомпилированным выражением. Альтернативы-lookahead
+# проверяются по порядку, поэтому приоритет тот же, что у цепочки if/elif; имя группы — код
+_SEND_ERR_RE = re.compile(
+    r"^(?=.*(?P<too_long>too long|longer than|video_note.*long|long.*video_note))"
+    r"|^(?=.*(?P<forbidden>forbidden.*(?:voice|video)|(?:voice|video).*forbidden))",
+    re.IGNORECASE | re.DOTALL,
+)
+_PROCESS_ERR_RE = re.compile(
+    r"^(?=.*(?P<ffmpeg_timeout>timeout|превысила лимит времени))"
+    r"|^(?=.*(?P<ffmpeg_error>ffmpeg ошибка))"
+    r"|^(?=.*(?P<tele_big>file is too big))"
+    r"|^(?=.*(?P<duration_limit>длительность))",
+    re.IGNORECASE | re.DOTALL,
+)
+# Отправка видео (не «кружка») запрещена в чате — тогда отправляем документом
+_SEND_VIDEO_ERR_RE = re.compile(
+    r"^(?=.*(?P<forbidden>forbidden.*video|video.*forbidden))",
+    re.IGNORECASE | re.DOTALL,
+)
+_HTTP_ERR_RE = re.compile(r"(?P<http_timeout>timeout)", re.IGNORECASE)
+
 
-# Простой анти-дубль: запоминаем обработанные сообщения на короткое время
+def _classify_error(pattern: re.Pattern, text: str, default: str = "other") -> str:
+    """Возвращает код ошибки (имя сработавшей группы pattern) или default."""
+    m = pattern.search(text)
+    return m.lastgroup if m else default
+
+
+# Простой анти-дубль: запоминаем обработанные сообщения на короткое время (значение — момент истечения)
 _processed_messages: dict[tuple[int, int], float] = {}
 _processed_ttl_seconds = 180.0
 
-# Глобальный лимитер параллелизма (Semaphore)
-try:
-    _max_concurrency = int(os.getenv("MAX_CONCURRENCY", "2"))
-except Exception:
-    _max_concurrency = 2
-_semaphore = asyncio.Semaphore(max(1, _max_concurrency))
 
-# Пер-юзер ограничение частоты запросов
+class DynamicLimiter:
+    """Лимитер параллелизма с изменяемой на лету ёмкостью.
+    
+    Счётчик активных задач под asyncio.Condition: в отличие от asyncio.Semaphore,
+    ёмкость можно безопасно менять во время работы (set_capacity), не трогая приватные поля.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self._active = 0
+        self._capacity = max(1, capacity)
+        self._cv = asyncio.Condition()
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    async def acquire(self) -> None:
+        async with self._cv:
+            await self._cv.wait_for(lambda: self._active < self._capacity)
+            self._active += 1
+
+    async def release(self) -> None:
+        # Счётчик уменьшаем сразу, до ожидания блокировки: отмена задачи в __aexit__ не должна
+        # «съесть» слот. Пробуждение ожидающего — под shield, чтобы оно тоже не потерялось
+        self._active -= 1
+        await asyncio.shield(self._notify_one())
+
+    async def _notify_one(self) -> None:
+        async with self._cv:
+            self._cv.notify(1)
+
+    async def set_capacity(self, capacity: int) -> None:
+        """Меняет ёмкость; при увеличении будит ожидающих, при уменьшении активные задачи доработают."""
+        async with self._cv:
+            self._capacity = max(1, capacity)
+            self._cv.notify_all()
+
+    async def __aenter__(self) -> "DynamicLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.release()
+
+
+# Лимиты обработки, MAX_CONCURRENCY и ADMIN_ID: разбираются один раз при импорте и заново по SIGHUP
+# (reload_config), а не на каждое сообщение. Объект неизменяемый — перезагрузка просто подменяет ссылку
+_cfg: LimitSettings = load_limit_settings()
+
+# Глобальный лимитер параллелизма (ёмкость меняется по SIGHUP, см. reload_config)
+_limiter = DynamicLimiter(_cfg.max_concurrency)
+
+# Отдельный лимит на одновременные кодирования FFmpeg (по умолчанию — число ядер CPU),
+# чтобы при большом MAX_CONCURRENCY параллельные x264 не перегружали процессор
 try:
-    _per_user_limit_s = float(os.getenv("USER_RATE_LIMIT_SECONDS", "20"))
+    _max_encode_concurrency = int(os.getenv("MAX_ENCODE_CONCURRENCY", "0")) or (os.cpu_count() or 2)
 except Exception:
-    _per_user_limit_s = 20.0
-_user_last_ts: dict[int, float] = {}
-_user_busy_until: dict[int, float] = {}
-_user_locks: dict[int, asyncio.Lock] = {}
+    _max_encode_concurrency = os.cpu_count() or 2
+_encode_semaphore = asyncio.Semaphore(max(1, _max_encode_concurrency))
+
+# Пер-юзер ограничение частоты запросов: корзина жетонов (token bucket) —
+# один жетон восстанавливается за USER_RATE_LIMIT_SECONDS, в запасе не больше USER_RATE_BURST
+# user_id -> (жетоны, момент последнего пересчёта)
+_user_tokens: dict[int, tuple[float, float]] = {}
+# Когда корзина снова наполнится: дальше запись не нужна (равна новой полной корзине)
+_user_bucket_until: dict[int, float] = {}
+# Пер-юзер Lock'и храним в LRU-порядке и не больше _user_locks_max (свободные вытесняются первыми)
+_user_locks: OrderedDict[int, asyncio.Lock] = OrderedDict()
+# Пер-юзер сериализация кодирования: видео одного пользователя конвертируются по очереди
+_user_encode_locks: OrderedDict[int, asyncio.Lock] = OrderedDict()
+_user_locks_max = 10_000
 
+# Ключ — media_group_id как есть (строка из Telegram), без лишнего str()
 _processed_groups: dict[str, float] = {}
 _groups_ttl_seconds = 300.0
 
+# Кэш разрешения чата на «кружки» (permissions.can_send_video_notes из get_chat), TTL 5 минут:
+# значение может быть None — Telegram не сообщил ограничение
+_chat_perms: dict[int, Optional[bool]] = {}
+_chat_perms_until: dict[int, float] = {}
+_chat_perms_ttl_seconds = 300.0
+# Single-flight: один запрос get_chat на чат, параллельные обработки ждут его результат
+_chat_perms_locks: dict[int, asyncio.Lock] = {}
+
+# Очередь истечения TTL-записей (min-heap по моменту истечения, time.monotonic):
+# (expiry, seq, словарь, ключ). Очистка снимает только просроченные элементы вместо полного обхода словарей
+_expiry_heap: list[tuple[float, int, dict, object]] = []
+_expiry_seq = itertools.count()
+
+# Подавать скачиваемый из Telegram файл сразу в stdin ffmpeg (скачивание и кодирование параллельно).
+# По умолчанию выключено: из трубы не читаются mp4 с moov-атомом в конце — тогда конвертация повторяется из файла
+_stream_to_ffmpeg = os.getenv("STREAM_TO_FFMPEG", "0").lower() in ("1", "true", "yes", "on")
+
+# Дисковый LRU-кэш скачанных из Telegram файлов по file_id (повторная отправка/ретрай не качает заново)
+_cache_dir = Path(os.getenv("TG_CACHE_DIR", "data/cache"))
+try:
+    _cache_max_files = int(os.getenv("TG_CACHE_MAX_FILES", "16"))
+except Exception:
+    _cache_max_files = 16
+_cache_lock = asyncio.Lock()
+
+async def reload_config() -> int:
+    """Перечитывает .env: лимиты обработки, ADMIN_ID и MAX_CONCURRENCY (применяется к лимитеру).
+    
+    Возвращает новую ёмкость лимитера.
+    """
+    global _cfg
+    reload_dotenv()
+    _cfg = load_limit_settings()
+    await _limiter.set_capacity(_cfg.max_concurrency)
+    return _limiter.capacity
+
+
+def _remember(store: dict, key: object, ttl: float, now: float) -> None:
+    """Сохраняет key в store до момента now + ttl и ставит его в очередь истечения."""
+    expiry = now + ttl
+    store[key] = expiry
+    heapq.heappush(_expiry_heap, (expiry, next(_expiry_seq), store, key))
+
+
+def _evict_expired(now: float) -> None:
+    """Удаляет истёкшие записи анти-дубля, альбомов, пер-юзер корзин и разрешений чатов (O(log n) на запись)."""
+    while _expiry_heap and _expiry_heap[0][0] <= now:
+        expiry, _, store, key = heapq.heappop(_expiry_heap)
+        # Ключ мог быть перезаписан с более поздним сроком — тогда его удалит свой элемент кучи
+        if store.get(key) != expiry:
+            continue
+        del store[key]
+        if store is _user_bucket_until:
+            # Корзина полна — забываем её и Lock пользователя, если он сейчас не занят
+            _user_tokens.pop(key, None)
+            lock = _user_locks.get(key)
+            if lock is not None and not lock.locked():
+                del _user_locks[key]
+        elif store is _url_file_ids_until:
+            _url_file_ids.pop(key, None)
+        elif store is _chat_perms_until:
+            _chat_perms.pop(key, None)
+            _drop_chat_perms_lock(key)
+
+
+async def _get_can_send_vn(bot, chat_id: int, chat_type: Optional[str] = None) -> Optional[bool]:
+    """Возвращает can_send_video_notes чата (None — неизвестно) из кэша или через get_chat.
+    
+    В личных чатах permissions у чата нет — ответ без запроса к API (основной случай для бота).
+    Ошибка запроса не кэшируется: в этом случае отправка «кружка» просто пробуется.
+    """
+    if chat_type == "private":
+        return True
+    if chat_id in _chat_perms_until:
+        return _chat_perms.get(chat_id)
+    lock = _chat_perms_locks.setdefault(chat_id, asyncio.Lock())
+    try:
+        async with lock:
+            # Пока ждали Lock, результат мог получить параллельный запрос
+            if chat_id in _chat_perms_until:
+                return _chat_perms.get(chat_id)
+            try:
+                chat_info = await bot.get_chat(chat_id)
+            except Exception:
+                return None
+            perms = getattr(chat_info, "permissions", None)
+            allowed = getattr(perms, "can_send_video_notes", None) if perms is not None else None
+            _chat_perms[chat_id] = allowed
+            _remember(_chat_perms_until, chat_id, _chat_perms_ttl_seconds, time.monotonic())
+            return allowed
+    finally:
+        # Ничего не закэшировано (ошибка get_chat, отмена) — истечения записи, которое убрало бы Lock, не будет
+        if chat_id not in _chat_perms_until:
+            _drop_chat_perms_lock(chat_id)
+
+
+def _drop_chat_perms_lock(chat_id: int) -> None:
+    """Удаляет Lock запроса разрешений чата, если он сейчас не занят."""
+    lock = _chat_perms_locks.get(chat_id)
+    if lock is not None and not lock.locked():
+        del _chat_perms_locks[chat_id]
+
+
+def _forget_chat_perms(chat_id: int) -> None:
+    """Сбрасывает закэшированные разрешения чата (например, после отказа в отправке «кружка»)."""
+    _chat_perms_until.pop(chat_id, None)
+    _chat_perms.pop(chat_id, None)
+    _drop_chat_perms_lock(chat_id)
+
+
+def _take_user_token(user_id: int, now: float) -> float:
+    """Снимает жетон из корзины пользователя.
+    
+    Возвращает 0, если задача допущена, иначе — сколько секунд ждать следующего жетона.
+    """
+    cfg = _cfg
+    if cfg.per_user_limit_s <= 0:
+        return 0.0
+    refill_per_s = 1.0 / cfg.per_user_limit_s
+    tokens, last = _user_tokens.get(user_id, (cfg.user_burst, now))
+    tokens = min(cfg.user_burst, tokens + (now - last) * refill_per_s)
+    if tokens < 1.0:
+        _user_tokens[user_id] = (tokens, now)
+        return (1.0 - tokens) / refill_per_s
+    tokens -= 1.0
+    _user_tokens[user_id] = (tokens, now)
+    _remember(_user_bucket_until, user_id, (cfg.user_burst - tokens) / refill_per_s, now)
+    return 0.0
+
+
+async def _try_admit_user(message: Message, user_id: int) -> bool:
+    """Пер-юзер «ворота»: снимает жетон под Lock пользователя.
+
+    Если жетонов нет, отвечает, сколько подождать, и возвращает False.
+    """
+    async with _get_user_lock(user_id):
+        wait_s = _take_user_token(user_id, time.monotonic())
+        if wait_s > 0:
+            await message.answer(f"Братишка, слишком много видео сразу, я так не умею работать. Отправляй по очереди, пожалуйста. Подожди {max(math.ceil(wait_s), 1)} сек и отправь следующее.")
+            return False
+    return True
+
+
+async def _answer_quietly(message: Message, text: str) -> None:
+    """Отправляет служебное сообщение; ошибка отправки не прерывает обработку."""
+    try:
+        await message.answer(text)
+    except TelegramAPIError:
+        pass
+
+
+def _lru_lock(locks: OrderedDict[int, asyncio.Lock], user_id: int) -> asyncio.Lock:
+    """Возвращает (и кэширует) Lock пользователя; сверх _user_locks_max вытесняет давно не нужный."""
+    lock = locks.get(user_id)
+    if lock is not None:
+        locks.move_to_end(user_id)
+        return lock
+    lock = asyncio.Lock()
+    locks[user_id] = lock
+    if len(locks) > _user_locks_max:
+        # Занятый Lock не трогаем — его ждут; словарь временно станет на запись больше
+        oldest = next(iter(locks.values()))
+        if not oldest.locked():
+            locks.popitem(last=False)
+    return lock
+
 
 def _get_user_lock(user_id: int) -> asyncio.Lock:
     """Возвращает (и кэширует) per-user Lock для атомарных проверок лимитов."""
-    lock = _user_locks.get(user_id)
-    if lock is None:
-        lock = asyncio.Lock()
-        _user_locks[user_id] = lock
-    return lock
+    return _lru_lock(_user_locks, user_id)
 
 
 @router.message(CommandStart())
@@ -68,17 +337,16 @@ async def cmd_start(message: Message) -> None:
     """Приветственное сообщение и краткая инструкция."""
     # Анти-дубль: если тот же message_id уже обрабатывался недавно, выходим
     key = (message.chat.id, message.message_id)
-    now = time.time()
-    for (c_id, m_id), ts in list(_processed_messages.items()):
-        if now - ts > _processed_ttl_seconds:
-            _processed_messages.pop((c_id, m_id), None)
-    if _processed_messages.get(key) and now - _processed_messages[key] <= _processed_ttl_seconds:
+    now = time.monotonic()
+    _evict_expired(now)
+    if key in _processed_messages:
         return
-    _processed_messages[key] = now
+    _remember(_processed_messages, key, _processed_ttl_seconds, now)
 
     # Аналитика: /start
-    if message.from_user:
-        record_start(message.from_user.id)
+    from_user = message.from_user
+    if from_user:
+        record_start(from_user.id)
 
     await message.answer(
         "Привет! Я могу превратить твои красивые видео в «кружки» хорошего качества.\n\n"
@@ -89,104 +357,205 @@ async def cmd_start(message: Message) -> None:
         "Просто пришли видео — и я верну его красивым кружочком."
     )
 
+def _format_detailed(d: dict) -> list[str]:
+    """Строки детальной статистики (общие для /stats и /stats_detailed)."""
+    lines = [f"- Ошибок всего: {d.get('total_errors', 0)}"]
+    top_errors = d.get("top_errors") or []
+    if top_errors:
+        lines.append("- Частые ошибки:")
+        lines += [f"  • {code}: {cnt}" for code, cnt in top_errors]
+    avg_ms = d.get("avg_processing_ms")
+    if avg_ms is not None:
+        lines.append(f"- Средняя длительность обработки: {avg_ms:.0f} мс")
+    sum_mb = (d.get("sum_output_bytes", 0) or 0) / 1048576
+    avg_b = d.get("avg_output_bytes")
+    if sum_mb:
+        lines.append(f"- Всего отправлено данных: {sum_mb:.2f} МБ")
+    if avg_b is not None:
+        lines.append(f"- Средний размер «кружка»: {avg_b / 1048576:.2f} МБ")
+    kinds = d.get("kinds") or []
+    if kinds:
+        lines.append("- Типы входного медиа:")
+        lines += [f"  • {kind}: {cnt}" for kind, cnt in kinds]
+    return lines
+
+
+def _is_admin(message: Message) -> bool:
+    """Отправитель — ADMIN_ID (если ADMIN_ID задан)."""
+    from_user = message.from_user
+    admin_id = _cfg.admin_id
+    return admin_id != 0 and from_user is not None and from_user.id == admin_id
+
+
 @router.message(Command("stats"))
 async def cmd_stats(message: Message) -> None:
     """Показывает админскую статистику: всего пользователей и обработок.
     
     Доступ: только ADMIN_ID (Telegram user id) из переменной окружения.
     """
-    admin_id = int(os.getenv("ADMIN_ID", "0") or "0")
-    if not message.from_user or message.from_user.id != admin_id or admin_id == 0:
+    if not _is_admin(message):
         return
     # Базовая статистика
     data = get_stats()
-    total_users = data.get("total_users", 0)
-    total_conv = data.get("total_conversions", 0)
     top = data.get("top_users", [])
     lines = [
         "Статистика бота:",
-        f"- Всего пользователей: {total_users}",
-        f"- Всего обработок: {total_conv}",
+        f"- Всего пользователей: {data.get('total_users', 0)}",
+        f"- Всего обработок: {data.get('total_conversions', 0)}",
     ]
     if top:
         lines.append("- Топ по обработкам:")
-        for uid, cnt in top:
-            lines.append(f"  • user_id={uid}: {cnt}")
-    # Расширенная статистика
-    d = get_detailed_stats()
-    lines.append("")  # пустая строка-разделитель
-    lines.append("Детальная статистика:")
-    lines.append(f"- Ошибок всего: {d.get('total_errors', 0)}")
-    top_errors = d.get("top_errors") or []
-    if top_errors:
-        lines.append("- Частые ошибки:")
-        for code, cnt in top_errors:
-            lines.append(f"  • {code}: {cnt}")
-    avg_ms = d.get("avg_processing_ms")
-    if avg_ms is not None:
-        lines.append(f"- Средняя длительность обработки: {avg_ms:.0f} мс")
-    sum_b = d.get("sum_output_bytes", 0) or 0
-    avg_b = d.get("avg_output_bytes")
-    if sum_b:
-        lines.append(f"- Всего отправлено данных: {sum_b/1024/1024:.2f} МБ")
-    if avg_b is not None:
-        lines.append(f"- Средний размер «кружка»: {avg_b/1024/1024:.2f} МБ")
-    kinds = d.get("kinds") or []
-    if kinds:
-        lines.append("- Типы входного медиа:")
-        for kind, cnt in kinds:
-            lines.append(f"  • {kind}: {cnt}")
+        lines += [f"  • user_id={uid}: {cnt}" for uid, cnt in top]
+    # Расширенная статистика (пустая строка-разделитель)
+    lines += ["", "Детальная статистика:", *_format_detailed(get_detailed_stats())]
     await message.answer("\n".join(lines))
 
 @router.message(Command("stats_detailed"))
 async def cmd_stats_detailed(message: Message) -> None:
     """Расширенная статистика: ошибки, средняя длительность, размеры, разбивка по типам."""
-    admin_id = int(os.getenv("ADMIN_ID", "0") or "0")
-    if not message.from_user or message.from_user.id != admin_id or admin_id == 0:
+    if not _is_admin(message):
         return
-    d = get_detailed_stats()
-    lines = [
-        "Детальная статистика:",
-        f"- Ошибок всего: {d.get('total_errors', 0)}",
-    ]
-    top_errors = d.get("top_errors") or []
-    if top_errors:
-        lines.append("- Частые ошибки:")
-        for code, cnt in top_errors:
-            lines.append(f"  • {code}: {cnt}")
-    avg_ms = d.get("avg_processing_ms")
-    if avg_ms is not None:
-        lines.append(f"- Средняя длительность обработки: {avg_ms:.0f} мс")
-    sum_b = d.get("sum_output_bytes", 0) or 0
-    avg_b = d.get("avg_output_bytes")
-    if sum_b:
-        lines.append(f"- Всего отправлено данных: {sum_b/1024/1024:.2f} МБ")
-    if avg_b is not None:
-        lines.append(f"- Средний размер «кружка»: {avg_b/1024/1024:.2f} МБ")
-    kinds = d.get("kinds") or []
-    if kinds:
-        lines.append("- Типы входного медиа:")
-        for kind, cnt in kinds:
-            lines.append(f"  • {kind}: {cnt}")
+    lines = ["Детальная статистика:", *_format_detailed(get_detailed_stats())]
     await message.answer("\n".join(lines))
-def _extract_file_id(message: Message) -> Tuple[Optional[str], str]:
-    """Определяет file_id из сообщения и человеческий тип объекта.
+
+
+@router.message(Command("concurrency"))
+async def cmd_concurrency(message: Message, command: CommandObject) -> None:
+    """Показывает или меняет на лету лимит одновременных задач: /concurrency [N].
+    
+    Доступ: только ADMIN_ID. Значение действует до перезапуска или SIGHUP (тогда берётся MAX_CONCURRENCY).
+    """
+    if not _is_admin(message):
+        return
+    arg = (command.args or "").strip()
+    if arg:
+        try:
+            capacity = int(arg)
+        except ValueError:
+            capacity = 0
+        if capacity < 1:
+            await message.answer("Использование: /concurrency [N], где N — целое число ≥ 1")
+            return
+        await _limiter.set_capacity(capacity)
+    await message.answer(f"Параллельных задач: {_limiter.active} из {_limiter.capacity}")
+
+
+def _is_video_doc(document: Document) -> bool:
+    """Документ — видео (mime_type video/*); регистр MIME-типа не важен, lower() всей строки не нужен."""
+    mt = document.mime_type
+    return bool(mt) and mt[:6].lower() == "video/"
+
+
+def _extract_media(message: Message) -> Tuple[Optional[Video | VideoNote | Document], str]:
+    """Определяет медиа-объект сообщения и человеческий тип объекта.
+    
+    Нужен только как запасной путь: профильные хендлеры передают объект из фильтра роутера.
     
     Возвращает:
-        (file_id или None, тип: 'video' | 'video_note' | 'document')
+        (объект или None, тип: 'video' | 'video_note' | 'document')
     """
-    if message.video:
-        return message.video.file_id, "video"
-    if message.video_note:
-        return message.video_note.file_id, "video_note"
-    if message.document:
-        # Документ может быть видео: проверим mime_type
-        mt = (message.document.mime_type or "").lower()
-        if mt.startswith("video/"):
-            return message.document.file_id, "document"
+    media = message.video
+    if media:
+        return media, "video"
+    media = message.video_note
+    if media:
+        return media, "video_note"
+    media = message.document
+    # Документ может быть видео: проверим mime_type
+    if media and _is_video_doc(media):
+        return media, "document"
     return None, "unknown"
 
 
+def _cache_lookup(file_id: str) -> Optional[Path]:
+    """Ищет файл в дисковом кэше по file_id (имя файла — sha1 от file_id + расширение)."""
+    if _cache_max_files <= 0:
+        return None
+    key = hashlib.sha1(file_id.encode()).hexdigest()
+    for path in _cache_dir.glob(f"{key}.*"):
+        if path.suffix != ".part":
+            return path
+    return None
+
+
+def _cache_trim() -> None:
+    """Удаляет самые давно использованные файлы кэша сверх TG_CACHE_MAX_FILES."""
+    files = sorted(
+        (p for p in _cache_dir.glob("*") if p.is_file() and p.suffix != ".part"),
+        key=lambda p: p.stat().st_mtime,
+    )
+    for path in files[: max(len(files) - _cache_max_files, 0)]:
+        path.unlink(missing_ok=True)
+
+
+def _link_or_copy(src: Path, dst: Path) -> None:
+    """Жёсткая ссылка на файл кэша (без копирования данных), либо копия, если ФС разные."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+# Верхняя граница предвыделения места под скачиваемый по ссылке файл
+_preallocate_max_bytes = 64 * 1024 * 1024
+
+
+@asynccontextmanager
+async def _temp_dir(prefix: str) -> AsyncIterator[Path]:
+    """Временная папка задачи; создание и rmtree (входное видео + результат) — в отдельном потоке, не в event loop."""
+    td = await asyncio.to_thread(tempfile.mkdtemp, prefix=prefix)
+    try:
+        yield Path(td)
+    finally:
+        await asyncio.to_thread(shutil.rmtree, td, ignore_errors=True)
+
+
+async def _stream_to_file(
+    chunks: AsyncIterator[bytes],
+    out_path: Path,
+    size_limit_bytes: int = 0,
+    expected_size: int = 0,
+) -> int:
+    """Пишет поток чанков прямо в файл (в памяти — не больше одного чанка); возвращает число байт.
+
+    Запись каждого чанка — в отдельном потоке (как aiofiles в bot.download): при троттлинге
+    записи на диск ожидает поток, а не event loop.
+
+    size_limit_bytes > 0 — прервать с RuntimeError, если поток длиннее лимита.
+    expected_size > 0 — заранее выделить место под файл (posix_fallocate, где поддерживается):
+    только при заданном size_limit_bytes и не больше _preallocate_max_bytes — заявленному сервером
+    размеру без верхней границы доверять нельзя.
+    """
+    written = 0
+    f = await asyncio.to_thread(out_path.open, "wb")
+    try:
+        preallocated = 0
+        if expected_size > 0 and size_limit_bytes > 0 and hasattr(os, "posix_fallocate"):
+            prealloc = min(expected_size, size_limit_bytes, _preallocate_max_bytes)
+            try:
+                # В потоке: без поддержки fallocate в ФС glibc эмулирует его записью нулей
+                await asyncio.to_thread(os.posix_fallocate, f.fileno(), 0, prealloc)
+                preallocated = prealloc
+            except OSError:
+                # ФС не поддерживает предвыделение — просто пишем как обычно
+                pass
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            await asyncio.to_thread(f.write, chunk)
+            written += len(chunk)
+            if size_limit_bytes > 0 and written > size_limit_bytes:
+                raise RuntimeError(
+                    f"Размер скачиваемого файла превысил лимит {size_limit_bytes // (1024 * 1024)} МБ."
+                )
+        if written < preallocated:
+            # Данных пришло меньше выделенного — обрезаем хвост из нулей
+            await asyncio.to_thread(f.truncate, written)
+    finally:
+        await asyncio.to_thread(f.close)
+    return written
+
+
 async def _download_file_to(
     message: Message,
     file_id: str,
@@ -195,65 +564,150 @@ async def _download_file_to(
     """Скачивает файл Telegram по file_id в указанный путь.
     
     Комментарии:
-    - Сначала получаем объект файла у Telegram (чтобы узнать оригинальный путь/расширение)
-    - Затем скачиваем его содержимое на диск
+    - Если файл уже есть в дисковом кэше (TG_CACHE_DIR), берём его оттуда без запросов к Telegram
+    - Иначе получаем объект файла у Telegram (чтобы узнать оригинальный путь/расширение)
+    - Затем скачиваем его содержимое в кэш и связываем с указанным путём
     """
+    async with _cache_lock:
+        # glob по каталогу кэша и utime — в отдельном потоке, как и остальная работа с ФС кэша
+        cached = await asyncio.to_thread(_cache_lookup, file_id)
+        if cached is not None:
+            # Обновляем mtime — это порядок LRU
+            await asyncio.to_thread(os.utime, cached)
+            src_path = dst_path.with_suffix(cached.suffix)
+            # Копия (если кэш на другой ФС) может быть долгой — не в event loop
+            await asyncio.to_thread(_link_or_copy, cached, src_path)
+            return src_path
     bot = message.bot
     file = await bot.get_file(file_id)
     # Если у Telegram есть расширение, используем его для исходного имени
     ext = Path(file.file_path or "").suffix or ".mp4"
     src_path = dst_path.with_suffix(ext)
-    await bot.download(file, destination=src_path)
+    if _cache_max_files <= 0:
+        await bot.download(file, destination=src_path)
+        return src_path
+    cache_path = _cache_dir / (hashlib.sha1(file_id.encode()).hexdigest() + ext)
+    # Качаем во временное имя: незавершённая загрузка не должна попасть в кэш
+    part_path = cache_path.with_name(f"{cache_path.stem}.{os.getpid()}.{id(dst_path)}.part")
+    try:
+        await asyncio.to_thread(_cache_dir.mkdir, parents=True, exist_ok=True)
+        try:
+            await bot.download(file, destination=part_path)
+            await asyncio.to_thread(part_path.replace, cache_path)
+        finally:
+            await asyncio.to_thread(part_path.unlink, missing_ok=True)
+        async with _cache_lock:
+            await asyncio.to_thread(_link_or_copy, cache_path, src_path)
+            # stat() по всем файлам кэша — тоже в отдельном потоке
+            await asyncio.to_thread(_cache_trim)
+    except OSError as e:
+        # Кэш — только оптимизация: проблемы с его каталогом не должны ломать конвертацию
+        log.warning("Дисковый кэш недоступен (%s), качаем файл напрямую", e)
+        await asyncio.to_thread(src_path.unlink, missing_ok=True)
+        await bot.download(file, destination=src_path)
     return src_path
 
 
+async def _cache_store(file_id: str, src_path: Path) -> None:
+    """Кладёт уже скачанный файл (копию потокового входа) в дисковый кэш под file_id."""
+    if _cache_max_files <= 0:
+        return
+    cache_path = _cache_dir / (hashlib.sha1(file_id.encode()).hexdigest() + src_path.suffix)
+    part_path = cache_path.with_name(f"{cache_path.stem}.{os.getpid()}.{id(src_path)}.part")
+
+    def store() -> None:
+        _cache_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            _link_or_copy(src_path, part_path)
+            part_path.replace(cache_path)
+        finally:
+            part_path.unlink(missing_ok=True)
+
+    async with _cache_lock:
+        await asyncio.to_thread(store)
+        await asyncio.to_thread(_cache_trim)
+
+
+async def _open_file_stream(
+    message: Message,
+    file_id: str,
+    dst_path: Path,
+) -> Tuple[Path, AsyncIterator[bytes]]:
+    """Готовит потоковое скачивание файла Telegram по file_id (без записи на диск).
+    
+    Возвращает путь, по которому сохранится копия входа (с расширением из Telegram),
+    и асинхронный итератор чанков содержимого.
+    """
+    bot = message.bot
+    file = await bot.get_file(file_id)
+    ext = Path(file.file_path or "").suffix or ".mp4"
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    stream = bot.session.stream_content(url=url, timeout=600, chunk_size=1024 * 128, raise_for_status=True)
+    return dst_path.with_suffix(ext), stream
+
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """Общая HTTP-сессия для скачивания по ссылкам: пул keep-alive соединений и DNS-кэш живут весь процесс."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=600),
+        )
+    return _session
+
+
+async def close_session() -> None:
+    """Закрывает общую HTTP-сессию (вызывается при остановке бота)."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
 async def _download_http_to(url: str, dst_path: Path) -> Path:
     """Скачивает файл по HTTP(S) в указанный путь.
     
     - При возможности определяет расширение из URL или Content-Type
     - Контроль максимального размера через HTTP_DOWNLOAD_MAX_MB (0 — без лимита)
     """
-    try:
-        max_mb = float(os.getenv("HTTP_DOWNLOAD_MAX_MB", "0"))
-    except Exception:
-        max_mb = 0.0
-    size_limit_bytes = int(max(max_mb, 0) * 1024 * 1024)
-    timeout = aiohttp.ClientTimeout(total=600)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.get(url) as resp:
-            if resp.status != 200:
-                raise RuntimeError(f"Не удалось скачать файл по ссылке: HTTP {resp.status}")
-            # Попробуем определить расширение
-            ext = ""
-            # Из URL
-            parsed = urlparse(url)
-            path_ext = Path(parsed.path).suffix
-            if path_ext:
-                ext = path_ext
-            # Из Content-Type
-            ct = resp.headers.get("Content-Type", "").lower()
-            if not ext and ct.startswith("video/"):
-                # Простейшее сопоставление
-                mapping = {
-                    "video/mp4": ".mp4",
-                    "video/quicktime": ".mov",
-                    "video/x-matroska": ".mkv",
-                    "video/webm": ".webm",
-                }
-                ext = mapping.get(ct, ".mp4")
-            if not ext:
-                ext = ".mp4"
-            out_path = dst_path.with_suffix(ext)
-            written = 0
-            with out_path.open("wb") as f:
-                async for chunk in resp.content.iter_chunked(1024 * 128):
-                    if not chunk:
-                        continue
-                    f.write(chunk)
-                    written += len(chunk)
-                    if size_limit_bytes > 0 and written > size_limit_bytes:
-                        raise RuntimeError(f"Размер скачиваемого файла превысил лимит {int(max_mb)} МБ.")
-            return out_path
+    session = await get_session()
+    async with session.get(url) as resp:
+        if resp.status != 200:
+            raise RuntimeError(f"Не удалось скачать файл по ссылке: HTTP {resp.status}")
+        # Попробуем определить расширение
+        ext = ""
+        # Из URL
+        parsed = urlparse(url)
+        path_ext = Path(parsed.path).suffix
+        if path_ext:
+            ext = path_ext
+        # Из Content-Type
+        ct = resp.headers.get("Content-Type", "").lower()
+        if not ext and ct.startswith("video/"):
+            # Простейшее сопоставление
+            mapping = {
+                "video/mp4": ".mp4",
+                "video/quicktime": ".mov",
+                "video/x-matroska": ".mkv",
+                "video/webm": ".webm",
+            }
+            ext = mapping.get(ct, ".mp4")
+        if not ext:
+            ext = ".mp4"
+        # Размер известен из заголовка — слишком большой файл отклоняем сразу, не скачивая
+        limit_bytes = _cfg.http_download_max_bytes
+        content_length = resp.content_length or 0
+        if limit_bytes > 0 and content_length > limit_bytes:
+            raise RuntimeError(f"Размер скачиваемого файла превысил лимит {limit_bytes // (1024 * 1024)} МБ.")
+        # Сжатый ответ (Content-Encoding) распаковывается — его размер заранее неизвестен
+        expected_size = 0 if resp.headers.get("Content-Encoding") else content_length
+        out_path = dst_path.with_suffix(ext)
+        await _stream_to_file(resp.content.iter_chunked(1024 * 1024), out_path, limit_bytes, expected_size)
+        return out_path
 
 
 async def _convert_and_send(
@@ -261,77 +715,84 @@ async def _convert_and_send(
     tmp_dir: Path,
     src_path: Path,
     size: int,
-    duration: Optional[int],
-) -> None:
+    kind: Optional[str] = None,
+    src_stream: Optional[AsyncIterator[bytes]] = None,
+) -> Optional[str]:
     """Конвертирует src_path в квадратный формат и отправляет как video_note/видео/документ.
     
-    - Проверяет лимит длительности (MAX_VIDEO_DURATION_SECONDS)
-    - Пишет техметрики и аналитику
+    Возвращает file_id отправленного «кружка» (None — ушёл как видео/документ или не отправлен).
+
+    - Проверяет лимит длительности (MAX_VIDEO_DURATION_SECONDS) в ходе конвертации, по тому же ffprobe
+    - Пишет техметрики и аналитику одной транзакцией (kind — тип входного медиа, если известен)
+    - src_stream: если задан, вход ещё скачивается и подаётся в ffmpeg потоком (копия пишется в src_path)
     """
+    max_duration_s = _cfg.max_video_duration_s
+    # Конвертация (асинхронные подпроцессы ffmpeg, event loop не блокируется)
+    out_path = tmp_dir / "output.mp4"
+    t0 = time.time()
+    bot = message.bot
+    chat_id = message.chat.id
+    from_user = message.from_user
+    user_id = from_user.id if from_user else 0
+    encode_lock = _lru_lock(_user_encode_locks, user_id)
+    # Разрешения чата на «кружки» запрашиваются, пока идёт (или ждёт очереди) кодирование
+    perms_task = asyncio.create_task(_get_can_send_vn(bot, chat_id, message.chat.type))
     try:
-        max_duration_s = int(os.getenv("MAX_VIDEO_DURATION_SECONDS", "60"))
-    except Exception:
-        max_duration_s = 60
-    # Если длительность заранее не была известна (например, ссылка), проверим через ffprobe
-    if duration is None:
-        duration_probe = await asyncio.to_thread(_probe_duration_seconds, src_path)
-        if duration_probe:
-            duration = int(duration_probe)
-    if duration is not None and duration > max_duration_s:
+        async with _encode_semaphore, encode_lock:
+            if src_stream is not None:
+                await convert_stream_to_square_video_note(
+                    src_stream, src_path, out_path, size, crf=14, max_duration_s=max_duration_s, hw_encoder="auto"
+                )
+            else:
+                # Длительность документов и ссылок заранее неизвестна — её проверит сама конвертация
+                await convert_to_square_video_note(
+                    src_path, out_path, size, crf=14, max_duration_s=max_duration_s, hw_encoder="auto"
+                )
+    except DurationExceeded as e:
+        perms_task.cancel()
+        if from_user and kind:
+            record_kind(user_id, kind)
         await message.answer(
-            f"Длительность видео {duration} сек превышает лимит {max_duration_s} сек. "
+            f"Длительность видео {e.duration} сек превышает лимит {e.limit} сек. "
             "Сократите ролик и попробуйте снова."
         )
-        return
-    # Конвертация (в отдельном потоке)
-    out_path = tmp_dir / "output.mp4"
-    t0 = time.time()
-    await asyncio.to_thread(
-        convert_to_square_video_note,
-        src_path,
-        out_path,
-        size,
-        False,
-        14,
-        "slow",
+        return None
+    except BaseException:
+        perms_task.cancel()
+        raise
+    # Сообщение о готовности уходит, пока дочитывается ответ get_chat (кэш на 5 минут)
+    _, allowed = await asyncio.gather(
+        message.answer("А вот как и обещал кружочек в хорошем качестве"),
+        perms_task,
     )
-    await message.answer("А вот как и обещал кружочек в хорошем качестве")
-    # Проверим разрешения чата на отправку видео-заметок
-    can_send_vn = True
-    try:
-        chat_info = await message.bot.get_chat(message.chat.id)
-        perms = getattr(chat_info, "permissions", None)
-        if perms is not None:
-            allowed = getattr(perms, "can_send_video_notes", None)
-            if allowed is False:
-                can_send_vn = False
-    except Exception:
-        pass
+    can_send_vn = allowed is not False
+    # Один InputFile на все попытки отправки (video_note → video → document);
+    # файл читается потоком по 128 КБ (у aiogram по умолчанию 64 КБ) — вдвое меньше чтений и записей в сокет
+    video_file = FSInputFile(out_path, chunk_size=1024 * 128)
+    sent_note_id: Optional[str] = None
     sent_as_note = False
     fallback_reason_forbidden = False
     if can_send_vn:
         try:
-            await message.bot.send_video_note(
-                chat_id=message.chat.id,
-                video_note=FSInputFile(out_path),
+            sent = await bot.send_video_note(
+                chat_id=chat_id,
+                video_note=video_file,
                 length=size,
             )
             sent_as_note = True
+            if sent.video_note:
+                sent_note_id = sent.video_note.file_id
         except (TelegramBadRequest, TelegramForbiddenError, TelegramAPIError) as send_err:
-            err_text = (str(send_err) or "").lower()
-            if "too long" in err_text or "longer than" in err_text or "video_note" in err_text and "long" in err_text:
-                await message.answer(
-                    f"Кружки в Telegram ограничены {max_duration_s} сек. "
-                    "Сократите ролик и отправьте снова, чтобы получить кружок."
-                )
-                sent_as_note = False
-            elif (
-                "forbidden" in err_text and ("voice" in err_text or "video" in err_text)
-            ) or "voice messages forbidden" in err_text or "video messages forbidden" in err_text:
-                sent_as_note = False
-                fallback_reason_forbidden = True
-            else:
-                sent_as_note = False
+            match _classify_error(_SEND_ERR_RE, str(send_err)):
+                case "too_long":
+                    await message.answer(
+                        f"Кружки в Telegram ограничены {max_duration_s} сек. "
+                        "Сократите ролик и отправьте снова, чтобы получить кружок."
+                    )
+                case "forbidden":
+                    fallback_reason_forbidden = True
+                    # Разрешения чата изменились — при следующей отправке запросим их заново
+                    _forget_chat_perms(chat_id)
     if not sent_as_note:
         if (not can_send_vn) or fallback_reason_forbidden:
             await message.answer(
@@ -339,277 +800,320 @@ async def _convert_and_send(
                 "Поэтому отправляю квадратное видео."
             )
         try:
-            await message.bot.send_video(
-                chat_id=message.chat.id,
-                video=FSInputFile(out_path),
+            await bot.send_video(
+                chat_id=chat_id,
+                video=video_file,
                 caption="Готово ✅",
             )
         except (TelegramBadRequest, TelegramForbiddenError, TelegramAPIError) as send_video_err:
-            err2 = (str(send_video_err) or "").lower()
-            if "forbidden" in err2 and "video" in err2:
+            if _classify_error(_SEND_VIDEO_ERR_RE, str(send_video_err)) == "forbidden":
                 await message.answer("В этом чате запрещены видео. Отправляю как файл.")
-                await message.bot.send_document(
-                    chat_id=message.chat.id,
-                    document=FSInputFile(out_path),
+                await bot.send_document(
+                    chat_id=chat_id,
+                    document=video_file,
                     caption="Готово ✅",
                 )
             else:
                 raise
     # Метрики
-    if message.from_user:
-        record_conversion(message.from_user.id)
+    if from_user:
         dt_ms = (time.time() - t0) * 1000.0
-        record_metric(message.from_user.id, "processing_ms", dt_ms)
         try:
-            out_size = out_path.stat().st_size
+            out_size = await asyncio.to_thread(os.path.getsize, out_path)
         except Exception:
             out_size = 0
-        if out_size:
-            record_metric(message.from_user.id, "output_size_bytes", float(out_size))
+        record_processing_batch(
+            user_id,
+            kind,
+            processing_ms=dt_ms,
+            output_size_bytes=float(out_size) if out_size else None,
+        )
+    return sent_note_id
 
 
 async def _process_and_reply_with_video_note(
     message: Message,
     size: int = 640,
+    media: Optional[Video | VideoNote | Document] = None,
+    kind: Optional[str] = None,
 ) -> None:
     """Скачивает медиа, конвертирует его в квадратный формат и отвечает video_note.
     
+    media/kind: медиа-объект и его тип, если хендлер уже получил их из фильтра;
+    иначе определяются по сообщению (_extract_media).
+    
     Основные шаги:
     1) Скачивание файла
     2) Конвертация через FFmpeg в 640x640 (H.264 + AAC)
     3) Отправка как answer_video_note
     """
+    # Атрибуты pydantic-модели читаем один раз
+    bot = message.bot
+    chat_id = message.chat.id
+    from_user = message.from_user
+    user_id = from_user.id if from_user else 0
+    now = time.monotonic()
+    _evict_expired(now)
     # Если пользователь отправил альбом (несколько видео сразу), берём только первое
-    if message.media_group_id:
-        mgid = str(message.media_group_id)
-        now = time.time()
-        # очистим устаревшие записи
-        for gid, ts in list(_processed_groups.items()):
-            if now - ts > _groups_ttl_seconds:
-                _processed_groups.pop(gid, None)
+    mgid = message.media_group_id
+    if mgid:
         if mgid in _processed_groups:
             await message.answer(
                 "В одной отправке обрабатываю только первое видео. "
                 "Пожалуйста, отправляйте остальные по очереди или через 20 секунд."
             )
             return
-        _processed_groups[mgid] = now
+        _remember(_processed_groups, mgid, _groups_ttl_seconds, now)
 
-    file_id, kind = _extract_file_id(message)
-    if not file_id:
+    if media is None:
+        media, kind = _extract_media(message)
+    if media is None:
         await message.answer("Не удалось распознать видео. Пришлите видео, видео-заметку или видео-документ.")
         return
-    # Аналитика: тип входного медиа
-    if message.from_user:
-        record_kind(message.from_user.id, kind)
     # Анти-дубль: если тот же message_id уже обрабатывался недавно, выходим
-    key = (message.chat.id, message.message_id)
-    now = time.time()
-    # очистим устаревшие записи
-    for (c_id, m_id), ts in list(_processed_messages.items()):
-        if now - ts > _processed_ttl_seconds:
-            _processed_messages.pop((c_id, m_id), None)
-    if _processed_messages.get(key) and now - _processed_messages[key] <= _processed_ttl_seconds:
+    key = (chat_id, message.message_id)
+    if key in _processed_messages:
         return
-    _processed_messages[key] = now
-
-    # Пользовательский лимит входного файла (по умолчанию выключено; задаётся USER_VIDEO_MAX_MB; 0 или <0 — отключить проверку)
-    try:
-        user_limit_mb = float(os.getenv("USER_VIDEO_MAX_MB", "0"))
-    except Exception:
-        user_limit_mb = 0.0
-    enforce_user_limit = user_limit_mb > 0
-    user_limit_bytes = int(max(user_limit_mb, 0) * 1024 * 1024)
+    _remember(_processed_messages, key, _processed_ttl_seconds, now)
+    file_id = media.file_id
 
     # Проверяем размер до скачивания
-    media_size = None
-    if message.video and message.video.file_size:
-        media_size = int(message.video.file_size)
-    elif message.video_note and message.video_note.file_size:
-        media_size = int(message.video_note.file_size)
-    elif message.document and message.document.file_size:
-        media_size = int(message.document.file_size)
-
-    if enforce_user_limit and media_size and media_size > user_limit_bytes:
-        if message.from_user:
-            record_error(message.from_user.id, "size_limit")
+    media_size = int(media.file_size) if media.file_size else None
+
+    # Пользовательский лимит входного файла (USER_VIDEO_MAX_MB; по умолчанию выключен)
+    cfg = _cfg
+    if cfg.user_video_max_bytes > 0 and media_size and media_size > cfg.user_video_max_bytes:
+        if from_user:
+            record_processing_batch(user_id, kind, error_code="size_limit")
         await message.answer(
             f"Слишком большой файл: ~{media_size // (1024 * 1024)} МБ. "
-            f"Максимальный размер — {int(user_limit_mb)} МБ.\n"
+            f"Максимальный размер — {int(cfg.user_video_max_mb)} МБ.\n"
             "Пожалуйста, уменьшите размер видео и попробуйте снова."
         )
         return
 
-    # Пер-юзер «ворота»: если одновременно пришло несколько видео,
-    # берём в работу только первое, остальные ждут 20 сек
-    user_id = message.from_user.id if message.from_user else 0
-    user_lock = _get_user_lock(user_id)
-    async with user_lock:
-        now = time.time()
-        busy_until = _user_busy_until.get(user_id, 0.0)
-        if busy_until > now:
-            wait_left = int(busy_until - now)
-            await message.answer(f"Братишка, слишком много видео сразу, я так не умею работать. Отправляй по очереди, пожалуйста. Подожди {max(wait_left, 1)} сек и отправь следующее.")
-            return
-        # Блокируем пользователя на период rate-limit (по умолчанию 20 сек)
-        _user_busy_until[user_id] = now + _per_user_limit_s
+    # Пер-юзер «ворота»: если жетоны кончились (слишком много видео подряд),
+    # просим подождать, пока восстановится следующий (по умолчанию 1 жетон за 20 сек, запас 2)
+    if not await _try_admit_user(message, user_id):
+        return
 
     # Лимит длительности (по умолчанию 60 сек, можно переопределить MAX_VIDEO_DURATION_SECONDS)
-    try:
-        max_duration_s = int(os.getenv("MAX_VIDEO_DURATION_SECONDS", "60"))
-    except Exception:
-        max_duration_s = 60
-    duration = None
-    if message.video and message.video.duration:
-        duration = int(message.video.duration)
-    elif message.video_note and message.video_note.duration:
-        duration = int(message.video_note.duration)
-    # Для документов длительность неизвестна заранее — проверим после скачивания (ниже)
+    max_duration_s = cfg.max_video_duration_s
+    # У документов поля duration нет
+    media_duration = getattr(media, "duration", None)
+    duration = int(media_duration) if media_duration else None
+    # Для документов длительность неизвестна заранее — её проверит конвертация (см. _convert_and_send)
+    if duration is not None and duration > max_duration_s:
+        if from_user:
+            record_kind(user_id, kind)
+        await message.answer(
+            f"Длительность видео {duration} сек превышает лимит {max_duration_s} сек. "
+            "Сократите ролик и попробуйте снова."
+        )
+        return
 
     # Параллелизм: не более N одновременных конвертаций
     # Используем upload_video (а не upload_video_note), чтобы не падать на чатах, где запрещены кружки
-    async with _semaphore, ChatActionSender.upload_video(chat_id=message.chat.id, bot=message.bot):
+    async with _limiter, ChatActionSender.upload_video(chat_id=chat_id, bot=bot):
+        # Сообщение пользователю о начале обработки уходит параллельно со скачиванием
+        ack_task = asyncio.create_task(
+            _answer_quietly(message, "Я уже работаю над твоим видосиком, скоро всё отправлю.")
+        )
         try:
-            # Сообщение пользователю о начале обработки
-            t0 = time.time()
-            await message.answer("Я уже работаю над твоим видосиком, скоро всё отправлю.")
-            with TemporaryDirectory(prefix="videonote_") as td:
-                tmp_dir = Path(td)
+            async with _temp_dir("videonote_") as tmp_dir:
                 # 1) Скачивание
                 source_path_hint = tmp_dir / "input"
-                src_path = await _download_file_to(message, file_id, source_path_hint)
-                # Если длительность заранее не была известна (документ), проверим через ffprobe
-                if duration is None:
-                    duration_probe = await asyncio.to_thread(_probe_duration_seconds, src_path)
-                    if duration_probe:
-                        duration = int(duration_probe)
-                if duration is not None and duration > max_duration_s:
-                    await message.answer(
-                        f"Длительность видео {duration} сек превышает лимит {max_duration_s} сек. "
-                        "Сократите ролик и попробуйте снова."
-                    )
-                    return
-                # 2-3) Конвертация и отправка
+                src_stream = None
+                if (
+                    _stream_to_ffmpeg
+                    and not bot.session.api.is_local
+                    and await asyncio.to_thread(_cache_lookup, file_id) is None
+                ):
+                    # Кодируем, не дожидаясь конца скачивания. Длительность документа заранее неизвестна:
+                    # слишком длинный скачивается целиком и кодируется до -t (лимит + 1 сек),
+                    # а DurationExceeded срабатывает уже по скачанной копии
+                    src_path, src_stream = await _open_file_stream(message, file_id, source_path_hint)
+                else:
+                    src_path = await _download_file_to(message, file_id, source_path_hint)
+                # Следующие сообщения пользователю — только после подтверждения
+                await ack_task
+                # 2-3) Конвертация и отправка (аналитика пишется внутри одной транзакцией)
                 await _convert_and_send(
                     message=message,
                     tmp_dir=tmp_dir,
                     src_path=src_path,
                     size=size,
-                    duration=duration,
+                    kind=kind,
+                    src_stream=src_stream,
                 )
+                if src_stream is not None:
+                    # Поток дочитан до конца — копия входа полная, кладём её в дисковый кэш.
+                    # Кружок уже отправлен: сбой кэша — не ошибка обработки для пользователя
+                    try:
+                        await _cache_store(file_id, src_path)
+                    except OSError as e:
+                        log.warning("Не удалось положить вход в дисковый кэш: %s", e)
         except Exception as e:
-            if message.from_user:
-                msg = (str(e) or "").lower()
-                if "timeout" in msg:
-                    code = "ffmpeg_timeout"
-                elif "ffmpeg ошибка" in msg:
-                    code = "ffmpeg_error"
-                elif "file is too big" in msg:
-                    code = "tele_big"
-                elif "длительность" in msg:
-                    code = "duration_limit"
-                else:
-                    code = "other"
-                record_error(message.from_user.id, code)
+            await ack_task
+            err_text = str(e)
+            code = _classify_error(_PROCESS_ERR_RE, err_text)
+            # Аргументы — лениво: строка собирается, только если запись реально выводится
+            log.warning("Ошибка обработки: user=%s kind=%s code=%s: %s", user_id, kind, code, err_text)
+            if from_user:
+                record_processing_batch(user_id, kind, error_code=code)
             # Дружелюбное пояснение к лимитам Telegram
-            if "file is too big" in (str(e) or "").lower():
+            if code == "tele_big":
                 await message.answer(
                     "Telegram не позволяет ботам скачивать файлы больше ~20 МБ. "
                     "Чтобы обработать большое видео, пришлите ссылку (http/https) на файл — я скачаю напрямую и конвертирую."
                 )
-            await message.answer(f"Ошибка при обработке видео: {e}")
+            await message.answer(f"Ошибка при обработке видео: {err_text}")
 
 
-@router.message(F.video)
-async def handle_video(message: Message) -> None:
+# Фильтры передают медиа-объект в хендлер (.as_), повторно разбирать сообщение не нужно
+@router.message(F.video.as_("video"))
+async def handle_video(message: Message, video: Video) -> None:
     """Обработчик обычных видео."""
-    await _process_and_reply_with_video_note(message)
+    await _process_and_reply_with_video_note(message, media=video, kind="video")
 
 
-@router.message(F.video_note)
-async def handle_video_note(message: Message) -> None:
+@router.message(F.video_note.as_("video_note"))
+async def handle_video_note(message: Message, video_note: VideoNote) -> None:
     """Обработчик видео-заметок (можно перекодировать для единообразия/качества)."""
-    await _process_and_reply_with_video_note(message)
+    await _process_and_reply_with_video_note(message, media=video_note, kind="video_note")
 
 
-@router.message(F.document)
-async def handle_document(message: Message) -> None:
+@router.message(F.document.as_("document"))
+async def handle_document(message: Message, document: Document) -> None:
     """Обработчик документов, если это видео (video/*)."""
-    mt = (message.document.mime_type or "").lower()
-    if mt.startswith("video/"):
-        await _process_and_reply_with_video_note(message)
+    if _is_video_doc(document):
+        await _process_and_reply_with_video_note(message, media=document, kind="document")
     else:
         await message.answer("Этот документ не является видео. Пришлите видео или видео-документ (video/*).")
 
 
-_url_regex = re.compile(r"(https?://\S+)", re.IGNORECASE)
+# Запасной поиск ссылки, если Telegram не разметил её entity (обычно ссылки уже приходят в message.entities)
+_url_regex = re.compile(r"https?://\S+")
+
+
+def _find_url(message: Message) -> Optional[str]:
+    """Первая http(s)-ссылка сообщения: из entities (url / text_link), иначе — регуляркой по тексту."""
+    text = message.text or ""
+    for entity in message.entities or ():
+        if entity.type == "url":
+            # Смещения entity — в UTF-16, extract_from учитывает это
+            url = entity.extract_from(text)
+        elif entity.type == "text_link":
+            url = entity.url or ""
+        else:
+            continue
+        # Ссылки без схемы (example.com/...) Telegram тоже размечает — их пропускаем, как и раньше
+        if url[:8].lower().startswith(("http://", "https://")):
+            return url
+    m = _url_regex.search(text)
+    return m.group(0) if m else None
+
+# Готовые «кружки» по ссылкам: (URL без #фрагмента, размер) -> file_id в Telegram, TTL сутки.
+# Повторная ссылка отправляется по file_id — без скачивания и FFmpeg
+_url_file_ids: OrderedDict[tuple[str, int], str] = OrderedDict()
+_url_file_ids_until: dict[tuple[str, int], float] = {}
+_url_file_ids_ttl_seconds = 86400.0
+_url_file_ids_max = 1000
 
 
-@router.message(F.text)
+def _url_cache_key(url: str, size: int) -> tuple[str, int]:
+    """Ключ кэша file_id: фрагмент (#...) на скачиваемый файл не влияет и отбрасывается."""
+    return urldefrag(url).url, size
+
+
+def _remember_url_file_id(key: tuple[str, int], file_id: str, now: float) -> None:
+    """Запоминает file_id «кружка» по ссылке; сверх _url_file_ids_max вытесняет самые старые."""
+    _url_file_ids[key] = file_id
+    _url_file_ids.move_to_end(key)
+    _remember(_url_file_ids_until, key, _url_file_ids_ttl_seconds, now)
+    while len(_url_file_ids) > _url_file_ids_max:
+        old_key, _ = _url_file_ids.popitem(last=False)
+        _url_file_ids_until.pop(old_key, None)
+
+
+def _forget_url_file_id(key: tuple[str, int]) -> None:
+    """Убирает file_id из кэша (например, Telegram больше не принимает его)."""
+    _url_file_ids.pop(key, None)
+    _url_file_ids_until.pop(key, None)
+
+
+# Команды (/start, /stats, ...) разбирают хендлеры выше; неизвестные до текстовых хендлеров не доходят
+@router.message(F.text, ~F.text.startswith("/"))
 async def handle_url_text(message: Message) -> None:
     """Обрабатывает текстовые сообщения с URL: скачивает видео по ссылке и конвертирует.
     
     Пример: пришлите ссылку https://... на файл видео (mp4/webm/mov/и т.п.)
     """
-    text = (message.text or "").strip()
-    if not text:
+    url = _find_url(message)
+    if not url:
         return
-    m = _url_regex.search(text)
-    if not m:
-        return
-    url = m.group(1)
     # Пер-юзер «ворота»
-    user_id = message.from_user.id if message.from_user else 0
-    user_lock = _get_user_lock(user_id)
-    async with user_lock:
-        now = time.time()
-        busy_until = _user_busy_until.get(user_id, 0.0)
-        if busy_until > now:
-            wait_left = int(busy_until - now)
-            await message.answer(f"Братишка, слишком много видео сразу, я так не умею работать. Отправляй по очереди, пожалуйста. Подожди {max(wait_left, 1)} сек и отправь следующее.")
+    bot = message.bot
+    from_user = message.from_user
+    user_id = from_user.id if from_user else 0
+    _evict_expired(time.monotonic())
+    if not await _try_admit_user(message, user_id):
+        return
+    chat_id = message.chat.id
+    # Эту ссылку уже конвертировали — отправляем готовый «кружок» по file_id
+    cache_key = _url_cache_key(url, 640)
+    cached_id = _url_file_ids.get(cache_key)
+    if cached_id is not None and await _get_can_send_vn(bot, chat_id, message.chat.type) is not False:
+        try:
+            await bot.send_video_note(chat_id=chat_id, video_note=cached_id, length=640)
+        except TelegramAPIError:
+            # file_id не принят — конвертируем заново
+            _forget_url_file_id(cache_key)
+        else:
+            if from_user:
+                record_processing_batch(user_id, None)
             return
-        _user_busy_until[user_id] = now + _per_user_limit_s
     # Параллелизм + индикация загрузки видео
-    async with _semaphore, ChatActionSender.upload_video(chat_id=message.chat.id, bot=message.bot):
+    async with _limiter, ChatActionSender.upload_video(chat_id=chat_id, bot=bot):
         try:
             await message.answer("Скачиваю видео по ссылке и готовлю кружочек, подождите немного…")
-            with TemporaryDirectory(prefix="videonote_url_") as td:
-                tmp_dir = Path(td)
+            async with _temp_dir("videonote_url_") as tmp_dir:
                 src_hint = tmp_dir / "input"
                 # Скачивание по HTTP(S)
                 src_path = await _download_http_to(url, src_hint)
                 # Конвертация и отправка
-                await _convert_and_send(
+                note_id = await _convert_and_send(
                     message=message,
                     tmp_dir=tmp_dir,
                     src_path=src_path,
                     size=640,
-                    duration=None,
                 )
+            if note_id:
+                _remember_url_file_id(cache_key, note_id, time.monotonic())
         except Exception as e:
-            if message.from_user:
-                msg = (str(e) or "").lower()
-                if "timeout" in msg:
-                    code = "http_timeout"
-                else:
-                    code = "http_error"
-                record_error(message.from_user.id, code)
-            await message.answer(f"Ошибка при загрузке или обработке ссылки: {e}")
+            err_text = str(e)
+            code = _classify_error(_HTTP_ERR_RE, err_text, default="http_error")
+            log.warning("Ошибка обработки ссылки: user=%s code=%s: %s", user_id, code, err_text)
+            if from_user:
+                record_error(user_id, code)
+            await message.answer(f"Ошибка при загрузке или обработке ссылки: {err_text}")
 
 
-@router.message()
+@router.message(~F.text.startswith("/"), ~F.video, ~F.video_note)
 async def handle_non_video(message: Message) -> None:
     """Фолбэк-валидация: если присылается не видео — отвечаем подсказкой.
     
-    Игнорируем команды (например, /start), чтобы не дублировать ответы.
+    Команды (например, /start) и видео сюда не попадают уже на уровне фильтров роутера.
     """
-    # Пропускаем команды
-    if message.text and message.text.startswith("/"):
+    # Пропускаем команды (страховка на случай изменения фильтров)
+    text = message.text
+    if text and text[0] == "/":
         return
     # Если это видео или документ с video/* — ничего не делаем (обработают профильные хендлеры)
     if message.video or message.video_note:
         return
-    if message.document and (message.document.mime_type or "").lower().startswith("video/"):
+    document = message.document
+    if document and _is_video_doc(document):
         return
     await message.answer(
         "Это не видео братик, возможно промахнулся когда жмякал на экран\n"
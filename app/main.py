@@ -1,13 +1,100 @@
 from __future__ import annotations
 
 import asyncio
+import hashlib
+import json
 import logging
+import os
+from pathlib import Path
+import signal
 
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.types import BotCommand
 
 from .config import load_settings
-from .handlers import router as media_router
+from .handlers import close_session, reload_config, router as media_router
+
+log = logging.getLogger(__name__)
+
+
+_DESCRIPTION = (
+    "Бот-конвертер: превращает ваши видео в «кружки» хорошего качества. "
+    "Отправь видео как медиа или файл — я автоматически обрежу до квадрата и верну кружок."
+)
+_SHORT_DESCRIPTION = "Конвертирует видео в «кружки»"
+_COMMANDS = [BotCommand(command="start", description="Инструкция и начало работы")]
+
+# Хэши последних установленных описания и команд: при рестарте без изменений запросы к API не нужны
+_PROFILE_STATE_PATH = Path(os.getenv("BOT_PROFILE_STATE_PATH", "data/bot_profile.json"))
+
+
+def _digest(bot_id: int, payload: object) -> str:
+    """Хэш значений вместе с ID бота (смена BOT_TOKEN на другого бота — повод выставить всё заново)."""
+    return hashlib.sha1(json.dumps([bot_id, payload], ensure_ascii=False).encode()).hexdigest()
+
+
+async def _setup_profile(bot: Bot) -> None:
+    """Выставляет описание и команды бота, если они изменились с прошлого запуска."""
+    try:
+        saved = json.loads(_PROFILE_STATE_PATH.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        saved = {}
+    if not isinstance(saved, dict):
+        # Валидный JSON, но не объект (файл испорчен вручную) — считаем, что состояния нет
+        saved = {}
+    state = {
+        "desc_hash": _digest(bot.id, [_DESCRIPTION, _SHORT_DESCRIPTION]),
+        "cmds_hash": _digest(bot.id, [c.model_dump() for c in _COMMANDS]),
+    }
+    if saved == state:
+        return
+    try:
+        if saved.get("desc_hash") != state["desc_hash"]:
+            await bot.set_my_description(_DESCRIPTION)
+            await bot.set_my_short_description(_SHORT_DESCRIPTION)
+        if saved.get("cmds_hash") != state["cmds_hash"]:
+            await bot.set_my_commands(_COMMANDS)
+    except Exception:
+        # Не удалось — состояние не сохраняем, попробуем при следующем запуске
+        return
+    try:
+        _PROFILE_STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        _PROFILE_STATE_PATH.write_text(json.dumps(state), encoding="utf-8")
+    except OSError:
+        pass
+
+
+# Ссылки на задачи перезагрузки по SIGHUP: event loop держит задачи только слабыми ссылками
+_sighup_tasks: set = set()
+
+
+async def _on_sighup() -> None:
+    capacity = await reload_config()
+    log.info("SIGHUP: настройки перечитаны, MAX_CONCURRENCY = %s", capacity)
+
+
+def _sighup_done(task: asyncio.Task) -> None:
+    _sighup_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("SIGHUP: не удалось перечитать настройки", exc_info=task.exception())
+
+
+def _handle_sighup() -> None:
+    task = asyncio.create_task(_on_sighup())
+    _sighup_tasks.add(task)
+    task.add_done_callback(_sighup_done)
+
+
+def _create_session() -> AiohttpSession:
+    """HTTP-сессия бота к Bot API: пул на 100 соединений, не больше 50 к одному хосту,
+    простаивающие keep-alive соединения живут 75 сек (у aiohttp по умолчанию 15) —
+    параллельные send_video/send_video_note не открывают TLS-соединение заново.
+    """
+    session = AiohttpSession(limit=100)
+    # ssl и ttl_dns_cache оставляем как настроил aiogram
+    session._connector_init.update(limit_per_host=50, keepalive_timeout=75)
+    return session
 
 
 async def main() -> None:
@@ -16,24 +103,31 @@ async def main() -> None:
         format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
     )
     settings = load_settings()
-    bot = Bot(token=settings.bot_token)
+    bot = Bot(token=settings.bot_token, session=_create_session())
     dp = Dispatcher()
     dp.include_router(media_router)
-
+    # SIGHUP — перечитать лимиты и MAX_CONCURRENCY без перезапуска (на Windows сигнала нет)
     try:
-        await bot.set_my_description(
-            "Бот-конвертер: превращает ваши видео в «кружки» хорошего качества. "
-            "Отправь видео как медиа или файл — я автоматически обрежу до квадрата и верну кружок."
-        )
-        await bot.set_my_short_description("Конвертирует видео в «кружки»")
-        await bot.set_my_commands([BotCommand(command="start", description="Инструкция и начало работы")])
-    except Exception:
-        
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, _handle_sighup)
+    except (AttributeError, NotImplementedError):
         pass
-    await dp.start_polling(bot)
+
+    await _setup_profile(bot)
+    try:
+        # allowed_updates не задаём: aiogram сам запрашивает только типы апдейтов, на которые есть хендлеры
+        # (dp.resolve_used_update_types(), сейчас — ["message"])
+        await dp.start_polling(bot)
+    finally:
+        await close_session()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop (если установлен) — более быстрый event loop для сетевого I/O; иначе стандартный asyncio
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
 
 